@@ -3,6 +3,33 @@ import dotenv from 'dotenv';
 
 dotenv.config({ silent: true });
 
+// The import script builds each generation of the graph in its own database and switches to it when
+// it is complete. It switches either a database alias, which is set as DB_DATABASE, or a generation
+// pointer, a node in DB_GENERATION_DATABASE that names the database of the current generation.
+const GENERATION_QUERY = 'MATCH (g:generation {name: $name}) RETURN g.database AS database';
+
+// Sessions of the driver open on the database given by getDatabase, the default database if none
+function withDatabase(driver, getDatabase) {
+  return {
+    session(config = {}) {
+      return driver.session(Object.assign({ database: getDatabase() }, config));
+    },
+    close() {
+      return driver.close();
+    },
+  };
+}
+
+async function readGeneration(driver, name) {
+  const session = driver.session({ database: process.env.DB_GENERATION_DATABASE });
+  try {
+    const result = await session.run(GENERATION_QUERY, { name });
+    return result.records.length ? result.records[0].get('database') : null;
+  } finally {
+    session.close();
+  }
+}
+
 async function createDriver() {
   const driver = neo4j.driver(
     process.env.DB_URL,
@@ -12,7 +39,22 @@ async function createDriver() {
     ),
   );
 
-  return driver;
+  const { DB_DATABASE, DB_GENERATION_DATABASE, DB_GENERATION_REFRESH } = process.env;
+  if (!DB_GENERATION_DATABASE) {
+    return DB_DATABASE ? withDatabase(driver, () => DB_DATABASE) : driver;
+  }
+
+  // Sessions keep the database they were opened on, so queries never span a switch
+  let database = await readGeneration(driver, DB_DATABASE);
+  setInterval(async () => {
+    try {
+      database = (await readGeneration(driver, DB_DATABASE)) || database;
+    } catch (e) {
+      console.log(`Reading the graph generation failed: ${e.message}`);
+    }
+  }, (DB_GENERATION_REFRESH || 30) * 1000).unref();
+
+  return withDatabase(driver, () => database);
 }
 
 // TODO: Run driver.close() when node app exits.
@@ -0,0 +1,35 @@
+import fs from 'fs';
+import path from 'path';
+import zlib from 'zlib';
+import { promisify } from 'util';
+import dotenv from 'dotenv';
+
+dotenv.config({ silent: true });
+
+const readFile = promisify(fs.readFile);
+const gunzip = promisify(zlib.gunzip);
+
+// Post bodies are not stored in the graph, but in the raw store written by the import script.
+// Each body is a gzip file named by the sha256 hash of its content, which post nodes keep as raw_hash.
+// A body that is missing from the store is null, like a post without a body, as are all bodies
+// if RAW_STORE_PATH is not set.
+const { RAW_STORE_PATH } = process.env;
+if (!RAW_STORE_PATH) {
+  console.log('RAW_STORE_PATH is not set, post bodies will be null');
+}
+
+async function readRawBody(rawHash) {
+  if (!RAW_STORE_PATH || !/^[0-9a-f]{64}$/.test(rawHash)) return null;
+  const file = path.join(RAW_STORE_PATH, rawHash.slice(0, 2), `${rawHash}.gz`);
+  let compressed;
+  try {
+    compressed = await readFile(file);
+  } catch (e) {
+    if (e.code === 'ENOENT') return null;
+    throw e;
+  }
+  const body = await gunzip(compressed);
+  return body.toString('utf8');
+}
+
+export default readRawBody;
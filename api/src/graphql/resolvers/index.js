@@ -5,6 +5,7 @@ import {
   findUserInteractionGraphForCorpus,
   findNodesByRelationshipAndLabel,
 } from '../connectors';
+import readRawBody from '../../db/rawStore';
 
 
 const resolvers = {
@@ -34,6 +35,12 @@ const resolvers = {
       return findNodesByRelationshipAndLabel({ driver, platform }, nodeId, 'CREATED', 'post');
     },
   },
+  post: {
+    // The full body is only read from the raw store when a client asks for it
+    raw({ raw_hash: rawHash }) {
+      return readRawBody(rawHash);
+    },
+  },
 };
 
 export default resolvers;
@@ -114,7 +114,10 @@ const typeDefs = `
     platform: String!
     post_number: Int!
     quote_count: Int!
-    raw: String!
+    raw: String
+    raw_excerpt: String
+    raw_hash: String
+    raw_length: Int
     reads: Int!
     reply_count: Int!
     score: String!
@@ -145,13 +148,16 @@ const typeDefs = `
     annotations_count: Int!
     created_at: String!
     creator_id: Int!
+    depth: Int
     description: String
     discourse_id: Int!
     name: String
     platform: String!
+    root_id: Int
     updated_at: String!
     on_platform: [platform]
     has_parent_code: [code]
+    has_ancestor: [code]
     has_codename: [codename]
     cooccurs: [code]
     annotations: [annotation]
@@ -223,6 +229,14 @@ const typeDefs = `
    to: code!
    corpus: String!
    count: Int!
+   jaccard: Float
+   pmi: Float
+  }
+  
+  type HAS_ANCESTOR {
+   from: code!
+   to: code!
+   depth: Int!
   }
   
   type USED_CODE {
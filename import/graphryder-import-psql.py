@@ -1,17 +1,54 @@
 import psycopg2
 import time
 import json
+import argparse
+import csv
+import gzip
 import hashlib
+import hmac
 import os
+import queue
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain
 from sys import exit
 from neo4j import GraphDatabase
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
 from pprint import pprint
 
+# pyarrow is optional, and only needed to write and load data files in Parquet format
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# numpy is optional, and only needed to count the interactions between users here rather than in Neo4j
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# scipy is optional, and only needed with numpy to count code cooccurrences here rather than in Neo4j
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
 # Python version 3.8.6
-# For this script to work, neo4j must have APOC installed and the neo4j.conf file 
+# For this script to work, neo4j must have APOC installed.
+# With the default APOC loader transport, Neo4j reads the data files itself, and the neo4j.conf file
 # must have the following properties set:
 # apoc.import.file.enabled=true
 # apoc.import.file.use_neo4j_config=false
+# With "loader_transport": "bolt", or the memory format, records are sent as parameters instead,
+# and Neo4j can run on another host without access to the data directory.
 
 with open("config.json") as json_config:
     config = json.load(json_config)
@@ -21,15 +58,776 @@ databases = config['databases']
 start_time = time.time()
 print("--- %s seconds ---" % (round(time.time() - start_time,2)))
 
-def get_data(db_cursor, db_name, db_root, salt):
+# In incremental mode, only rows changed since the last import are extracted and merged into the existing graph.
+incremental = config.get('incremental', False)
+
+def delta_condition(watermarks, table, column='updated_at'):
+    # Restricts an extraction query to rows that changed since the watermark of the last run.
+    # Without a watermark for the table, there is no condition and the full table is read.
+    if table not in watermarks:
+        return None
+    return f'{column} >= %({table})s'
+
+def where(*conditions):
+    # Combine the conditions that apply to a query into its WHERE clause
+    conditions = [condition for condition in conditions if condition]
+    if not conditions:
+        return ''
+    return 'WHERE ' + ' AND '.join(f'({condition})' for condition in conditions)
+
+# Omit rules, compiled into the extraction queries by omit_conditions
+
+# Omit private messages from the graph
+omit_private_messages = config.get('omit_private_messages', True)
+
+# Omit protected content (posts, categories, groups) from the graph.
+# Content that is not readable by all logged in users is considered protected.
+# This also omits 'hidden' posts, also known as 'whispers'.
+# In the future, we may want to handle 'hidden' posts separately if we 
+# if we want to give access to the graph based on the permissions of a loggen in user.
+omit_protected_content = config.get('omit_protected_content', True)
+
+# This omits content created by system users and by deleted users.
+# It also omits those users completely from the graph.
+omit_system_users = config.get('omit_system_users', True)
+
+def omit_conditions(db_root):
+    # Compile the omit rules into SQL conditions per extracted table, so omitted rows never leave the database.
+    # Conditions refer to the tables by the names used in the extraction queries.
+
+    def private_topic(topic_id):
+        return f'EXISTS (SELECT 1 FROM {db_root}.topic_allowed_users AS allowed WHERE allowed.topic_id = {topic_id})'
+
+    def private_post(post_id):
+        return f'EXISTS (SELECT 1 FROM {db_root}.posts AS p JOIN {db_root}.topic_allowed_users AS allowed ON allowed.topic_id = p.topic_id WHERE p.id = {post_id})'
+
+    def protected_topic(topic_id):
+        # Private messages, topics without a category and topics in read restricted categories are protected
+        return (
+            f'{private_topic(topic_id)} OR NOT EXISTS ('
+            f'SELECT 1 FROM {db_root}.topics AS t JOIN {db_root}.categories AS c ON c.id = t.category_id '
+            f'WHERE t.id = {topic_id} AND NOT c.read_restricted)'
+        )
+
+    def post_conditions(posts):
+        conditions = []
+        if omit_private_messages:
+            conditions.append(f'NOT {private_topic(f"{posts}.topic_id")}')
+        if omit_protected_content:
+            conditions.append(f'NOT {posts}.hidden')
+            conditions.append(f'NOT ({protected_topic(f"{posts}.topic_id")})')
+        return conditions
+
+    def visible_post(post_id):
+        return f'{post_id} IN (SELECT p.id FROM {db_root}.posts AS p WHERE {" AND ".join(post_conditions("p"))})'
+
+    conditions = {
+        'users': [],
+        'groups': [],
+        'categories': [],
+        'category_groups': [],
+        'topics': [],
+        'posts': post_conditions('posts'),
+        'quotes': [],
+        'likes': [],
+        'annotations': []
+    }
+    if omit_system_users:
+        conditions['users'].append('users.id >= 0')
+    if omit_private_messages:
+        conditions['topics'].append(f'NOT {private_topic("topics.id")}')
+        conditions['quotes'].append(f'NOT {private_post("quoted_posts.post_id")}')
+        conditions['quotes'].append(f'NOT {private_post("quoted_posts.quoted_post_id")}')
+        conditions['likes'].append(f'NOT {private_post("post_actions.post_id")}')
+        conditions['annotations'].append(f'NOT {private_post("annotations.post_id")}')
+    if omit_protected_content:
+        # Group visibility levels, public=0, logged_on_users=1, members=2, staff=3, owners=4
+        conditions['groups'].append('groups.visibility_level <= 1')
+        conditions['categories'].append('NOT categories.read_restricted')
+        conditions['category_groups'].append(f'category_groups.group_id IN (SELECT id FROM {db_root}.groups WHERE visibility_level <= 1)')
+        conditions['category_groups'].append(f'category_groups.category_id IN (SELECT id FROM {db_root}.categories WHERE NOT read_restricted)')
+        conditions['topics'].append(f'NOT ({protected_topic("topics.id")})')
+        if not omit_private_messages:
+            conditions['quotes'].append(f'NOT {private_post("quoted_posts.quoted_post_id")}')
+        conditions['quotes'].append(visible_post('quoted_posts.post_id'))
+        conditions['likes'].append(visible_post('post_actions.post_id'))
+        conditions['annotations'].append(visible_post('annotations.post_id'))
+    return conditions
+
+def omitted(conditions):
+    # The inverse of a table's omit conditions, to find changed rows that are now omitted
+    if not conditions:
+        return None
+    return 'NOT (' + ' AND '.join(f'({condition})' for condition in conditions) + ')'
+
+def track_watermark(rows, watermarks, table, column):
+    # Passes rows through while moving the watermark of a table to the newest updated_at value among them.
+    newest = None
+    for row in rows:
+        if row[column] is not None and (newest is None or row[column] > newest):
+            newest = row[column]
+        yield row
+    if newest is not None:
+        watermarks[table] = newest.isoformat()
+
+# Number of rows fetched per round trip when streaming large tables from the database
+itersize = config.get('extraction_itersize', 2000)
+
+def stream_query(db_conn, name, query, params=None):
+    # Iterate over the rows of a query using a named, server-side cursor.
+    # Only itersize rows are held in memory at a time, instead of the full result.
+    with db_conn.cursor(name=f'graphryder_{name}') as cursor:
+        cursor.itersize = itersize
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+
+# Number of connections per database used to run independent queries concurrently
+connections = config.get('extraction_connections', 4)
+
+def open_snapshot_pool(db, size):
+    # Open a small pool of connections that all read from the same REPEATABLE READ snapshot,
+    # so that queries running concurrently see one consistent state of the database.
+    # psycopg2.pool is not used as it rolls back the transaction, and the snapshot, when a connection is returned.
+    pool = queue.Queue(maxsize=size)
+    snapshot = None
+    for i in range(size):
+        db_conn = psycopg2.connect(
+            host=db['host'], 
+            port=db['port'], 
+            dbname=db['dbname'], 
+            user=db['user'], 
+            password=db['password']
+        )
+        db_conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with db_conn.cursor() as db_cursor:
+            if snapshot is None:
+                db_cursor.execute('SELECT pg_export_snapshot()')
+                snapshot = db_cursor.fetchone()[0]
+            else:
+                db_cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+        pool.put(db_conn)
+    return pool
+
+def close_pool(pool):
+    while not pool.empty():
+        db_conn = pool.get()
+        db_conn.rollback()
+        db_conn.close()
+
+@contextmanager
+def pooled_connection(pool):
+    db_conn = pool.get()
+    try:
+        yield db_conn
+    finally:
+        pool.put(db_conn)
+
+def fetch_all(pool, query, params=None):
+    with pooled_connection(pool) as db_conn:
+        with db_conn.cursor() as db_cursor:
+            db_cursor.execute(query, params)
+            return db_cursor.fetchall()
+
+def run_concurrently(pool, tasks):
+    # Run independent extraction tasks, at most one per connection in the pool, and return their results by name.
+    with ThreadPoolExecutor(max_workers=pool.maxsize) as executor:
+        futures = {name: executor.submit(task) for name, task in tasks.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+# Use COPY to extract the largest tables, which is much faster than fetching rows through a cursor
+extraction_copy = config.get('extraction_copy', True)
+
+# COPY text format escapes, see https://www.postgresql.org/docs/current/sql-copy.html
+copy_escapes = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+def copy_text(value):
+    if '\\' in value:
+        return re.sub(r'\\(.)', lambda m: copy_escapes.get(m.group(1), m.group(1)), value)
+    return value
+
+def copy_bool(value):
+    return value == 't'
+
+def copy_timestamp(value):
+    # Postgres trims trailing zeros of fractional seconds, which fromisoformat does not accept
+    timestamp, _, fraction = value.partition('.')
+    return datetime.fromisoformat(timestamp).replace(microsecond=int(fraction.ljust(6, '0')) if fraction else 0)
+
+def copy_int_array(value):
+    if value == '{}':
+        return []
+    return [None if v == 'NULL' else int(v) for v in value[1:-1].split(',')]
+
+def copy_query(db_conn, query, params, types):
+    # Iterate over the rows of a query exported with COPY ... TO STDOUT.
+    # COPY writes into a pipe from a thread, and rows are parsed from the other end as they arrive,
+    # converted with the given function per column so they match rows fetched through a cursor.
+    with db_conn.cursor() as db_cursor:
+        copy_sql = db_cursor.mogrify(f'COPY ({query}) TO STDOUT', params).decode('utf-8')
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def copy():
+        try:
+            with open(write_fd, 'wb') as pipe, db_conn.cursor() as db_cursor:
+                db_cursor.copy_expert(copy_sql, pipe)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=copy)
+    thread.start()
+    try:
+        with open(read_fd, encoding='utf-8', newline='\n') as pipe:
+            for line in pipe:
+                yield tuple(
+                    None if field == '\\N' else convert(field)
+                    for convert, field in zip(types, line[:-1].split('\t'))
+                )
+    finally:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def extract_query(db_conn, name, query, params, types):
+    # Stream a large table with COPY, or with a server-side cursor if COPY is turned off
+    if extraction_copy:
+        return copy_query(db_conn, query, params, types)
+    return stream_query(db_conn, name, query, params)
+
+# Post bodies are kept out of the graph, in a local store of compressed files named by the hash of their content.
+# Post nodes keep an excerpt, the length and the hash, which the API uses to read the full body when it is asked for.
+raw_store_path = config.get('raw_store_path', './raw')
+raw_excerpt_length = config.get('raw_excerpt_length', 280)
+
+def store_raw(raw):
+    # Write a post body to the raw store and return its hash.
+    # Bodies that are already stored, by this or an earlier import, are not written again.
+    raw_bytes = raw.encode('utf-8')
+    raw_hash = hashlib.sha256(raw_bytes).hexdigest()
+    directory = f'{raw_store_path}/{raw_hash[:2]}'
+    path = f'{directory}/{raw_hash}.gz'
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        # Other threads and processes may be writing the same body, so it is written under a temporary name first
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_path, 'wb') as file:
+            file.write(gzip.compress(raw_bytes, mtime=0))
+        os.replace(temp_path, path)
+    return raw_hash
+
+class IdSet:
+    # A read-only set of integer ids, stored as a sorted array of 8 byte integers.
+    # A Python set of ints takes around 10 times as much memory, for the hash table and an object per id.
+    __slots__ = ('ids',)
+
+    def __init__(self, ids):
+        self.ids = array('q', sorted(ids))
+
+    def __contains__(self, id):
+        i = bisect_left(self.ids, id)
+        return i < len(self.ids) and self.ids[i] == id
+
+    def __len__(self):
+        return len(self.ids)
+
+# Chunks are sized by a byte budget per topic, so that small records like likes go in large chunks
+# and posts in smaller ones. Chunks are closed at the budget or at the maximum number of records.
+chunk_bytes = config.get('chunk_bytes', 4000000)
+chunk_bytes_by_topic = config.get('chunk_bytes_by_topic', {})
+chunk_max_rows = config.get('chunk_max_rows', 50000)
+
+def chunk_budget(data_topic):
+    return chunk_bytes_by_topic.get(data_topic, chunk_bytes)
+
+# JSON chunks can be written gzip compressed, which apoc.load.json reads with its compression option.
+# Chunks are compressed by a pool of threads while extraction continues. Parquet files use the same codec.
+chunk_compression = config.get('chunk_compression', None)
+if chunk_compression not in (None, 'gzip'):
+    # Chunk files are only written and read back gzip compressed, other codecs could not be loaded
+    print(f'Unknown chunk_compression {chunk_compression!r}, it must be null or "gzip".')
+    exit(1)
+compression_level = config.get('compression_level', 6)
+compression_workers = config.get('compression_workers', os.cpu_count())
+compression_pool = ThreadPoolExecutor(max_workers=compression_workers) if chunk_compression else None
+# Chunks waiting to be compressed are held in memory, so only a few may be queued at a time
+compression_slots = threading.BoundedSemaphore(2 * compression_workers)
+
+def write_chunk(path, parts):
+    # Write a chunk file, and return its size and checksum
+    data = b''.join(parts)
+    with open(path, 'wb') as file:
+        file.write(data)
+    return len(data), hashlib.sha256(data).hexdigest()
+
+def compress_chunk(path, parts):
+    # zlib releases the GIL while compressing, so chunks are compressed in parallel
+    try:
+        return write_chunk(path, [gzip.compress(b''.join(parts), compresslevel=compression_level, mtime=0)])
+    finally:
+        compression_slots.release()
+
+# Chunks are keyed by ranges of ids, so that a chunk keeps its key and its content as long as none of its records change.
+# Within a range, chunks are numbered as they fill the byte budget.
+# Unchanged chunks are not written again, and not loaded into the graph again in incremental mode.
+chunk_id_range = config.get('chunk_id_range', 10000)
+
+# Records are chunked by id, and links between posts by the post they belong to
+chunk_key_columns = {
+    'replies': 'post_id',
+    'quotes': 'post_id',
+    'likes': 'post_id'
+}
+
+def chunk_key(record, data_topic, chunk_parts):
+    # Key of the next chunk for a record. Records arrive ordered by their key column,
+    # but if they do not, keys stay unique, only less stable.
+    bucket = record[chunk_key_columns.get(data_topic, 'id')] // chunk_id_range
+    part = chunk_parts.get(bucket, 0)
+    chunk_parts[bucket] = part + 1
+    return bucket, f'{bucket}-{part}'
+
+def load_manifest(db_name, name='manifest'):
+    try:
+        with open(f'./db/{db_name}_{name}.json') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def dump_chunks(records, db_name, data_topic, chunk_sizes, manifest, previous):
+    # Save records in chunks, keyed by id range and within the byte budget of the topic, as they arrive.
+    # Records can be any iterable, including generators streaming from the database.
+    # Each chunk is collected in memory, and only written if its content differs from the previous manifest.
+    # Compressed chunks are handed to the compression pool, so extraction continues while they are written.
+    # The key, row count, content hash, size and checksum of each chunk file are added to the manifest.
+    if intermediate_format == 'parquet' and data_topic in parquet_topics:
+        return dump_row_groups(records, db_name, data_topic, chunk_sizes, manifest)
+    if intermediate_format == 'memory':
+        return keep_chunks(records, db_name, data_topic, chunk_sizes, manifest)
+    path = './db/'
+    extension = '.json.gz' if chunk_compression else '.json'
+    budget = chunk_budget(data_topic)
+    previous_chunks = {chunk['key']: chunk for chunk in previous.get(data_topic, {}).get('chunks', [])}
+    count = 0
+    unchanged = 0
+    chunks = []
+    chunk_parts = {}
+    written = []
+    parts = None
+    bucket = None
+    size = 0
+
+    def add(text):
+        nonlocal size
+        data = text.encode('utf-8')
+        size += len(data)
+        parts.append(data)
+        content.update(data)
+
+    def close():
+        nonlocal unchanged
+        add(']')
+        chunk = chunks[-1]
+        chunk['content'] = content.hexdigest()
+        old = previous_chunks.get(chunk['key'])
+        if old and old['content'] == chunk['content'] and old['file'] == chunk['file'] and os.path.exists(f'{path}{chunk["file"]}'):
+            chunk['bytes'], chunk['sha256'] = old['bytes'], old['sha256']
+            unchanged += 1
+        elif chunk_compression:
+            compression_slots.acquire()
+            written.append((chunk, compression_pool.submit(compress_chunk, f'{path}{chunk["file"]}', parts)))
+        else:
+            chunk['bytes'], chunk['sha256'] = write_chunk(f'{path}{chunk["file"]}', parts)
+
+    try:
+        for record in records:
+            record_bucket = record[chunk_key_columns.get(data_topic, 'id')] // chunk_id_range
+            if parts is None or record_bucket != bucket or chunks[-1]['rows'] == chunk_max_rows or size >= budget:
+                if parts is not None:
+                    close()
+                bucket, key = chunk_key(record, data_topic, chunk_parts)
+                chunks.append({'key': key, 'file': f'{db_name}_{data_topic}_{key}{extension}', 'rows': 0})
+                parts = []
+                content = hashlib.sha256()
+                size = 0
+                add('[')
+            else:
+                add(', ')
+            add(json.dumps(record, default=str))
+            chunks[-1]['rows'] += 1
+            count += 1
+    finally:
+        if parts is not None:
+            close()
+        for chunk, future in written:
+            chunk['bytes'], chunk['sha256'] = future.result()
+    if unchanged:
+        print(f'    {unchanged} of {len(chunks)} {data_topic} chunks are unchanged.')
+    chunk_sizes[data_topic] = len(chunks)
+    manifest[data_topic] = {'format': 'json', 'chunks': chunks}
+    return count
+
+# Data files are written as JSON chunks, or as Parquet files with typed columns if pyarrow is installed.
+# Only the large tables streamed from the database are written to Parquet, the others are always small
+# and have columns with mixed types.
+# With the memory format no data files are written, chunks are kept in memory and sent to Neo4j as parameters.
+intermediate_format = config.get('intermediate_format', 'json')
+parquet_topics = ('posts', 'replies', 'quotes', 'likes', 'annotations')
+
+if intermediate_format == 'parquet' and pa is None:
+    print('Writing Parquet data files needs pyarrow, writing JSON instead.')
+    intermediate_format = 'json'
+
+# Chunks of the memory format, by dataset, topic and key
+memory_chunks = {}
+
+def plain(value):
+    # Values as they would be read back from a JSON chunk, with timestamps as strings
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    return str(value)
+
+def keep_chunks(records, db_name, data_topic, chunk_sizes, manifest):
+    # Keep records in memory in chunks keyed like the chunk files, for an import that does not touch disk.
+    # Chunks are not serialized, so they have no content hash and are never skipped as unchanged.
+    count = 0
+    chunks = []
+    chunk_parts = {}
+    bucket = None
+    for record in records:
+        record_bucket = record[chunk_key_columns.get(data_topic, 'id')] // chunk_id_range
+        if not chunks or record_bucket != bucket or chunks[-1]['rows'] == chunk_max_rows:
+            bucket, key = chunk_key(record, data_topic, chunk_parts)
+            chunks.append({'key': key, 'rows': 0, 'content': None})
+            rows = memory_chunks[(db_name, data_topic, key)] = []
+        rows.append(plain(record))
+        chunks[-1]['rows'] += 1
+        count += 1
+    chunk_sizes[data_topic] = len(chunks)
+    manifest[data_topic] = {'format': 'memory', 'chunks': chunks}
+    return count
+
+def parquet_schema(data_topic):
+    timestamp = pa.timestamp('us')
+    ids = pa.list_(pa.int64())
+    schemas = {
+        'posts': [
+            ('id', pa.int64()), ('user_id', pa.int64()), ('topic_id', pa.int64()), ('post_number', pa.int64()),
+            ('raw_excerpt', pa.string()), ('raw_length', pa.int64()), ('raw_hash', pa.string()),
+            ('created_at', timestamp), ('updated_at', timestamp), ('deleted_at', timestamp),
+            ('hidden', pa.bool_()), ('read_restricted', pa.bool_()), ('word_count', pa.int64()), ('wiki', pa.bool_()),
+            ('reads', pa.int64()), ('score', pa.float64()), ('like_count', pa.int64()), ('reply_count', pa.int64()),
+            ('quote_count', pa.int64()), ('quotes_posts', ids), ('is_reply_to', ids), ('is_liked_by', ids),
+            ('is_private', pa.bool_())
+        ],
+        'replies': [('post_id', pa.int64()), ('reply_post_id', pa.int64())],
+        'quotes': [('post_id', pa.int64()), ('quoted_post_id', pa.int64())],
+        'likes': [('post_id', pa.int64()), ('user_id', pa.int64())],
+        'annotations': [
+            ('id', pa.int64()), ('text', pa.string()), ('quote', pa.string()),
+            ('created_at', timestamp), ('updated_at', timestamp), ('tag_id', pa.int64()), ('post_id', pa.int64()),
+            ('creator_id', pa.int64()), ('type', pa.string()), ('topic_id', pa.int64())
+        ]
+    }
+    return pa.schema(schemas[data_topic])
+
+def table_content(table):
+    # Hash of the records in a table, from its Arrow IPC serialization
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as stream:
+        stream.write_table(table)
+    return hashlib.sha256(sink.getvalue().to_pybytes()).hexdigest()
+
+def dump_row_groups(records, db_name, data_topic, chunk_sizes, manifest):
+    # Save records to a Parquet file in row groups, keyed by id range, as they arrive.
+    # The Neo4j loader reads each row group as one chunk.
+    # The number of records per row group is limited from the average size of the records so far,
+    # to fit the byte budget of the topic.
+    # The file is always written in full, but row groups with unchanged content are not loaded again.
+    schema = parquet_schema(data_topic)
+    budget = chunk_budget(data_topic)
+    rows = min(1000, chunk_max_rows)
+    count = 0
+    chunks = []
+    chunk_parts = {}
+    bucket = None
+    columns = {name: [] for name in schema.names}
+
+    def write_row_group():
+        table = pa.Table.from_pydict(columns, schema=schema)
+        writer.write_table(table, row_group_size=table.num_rows)
+        chunks[-1]['content'] = table_content(table)
+        return max(1, min(chunk_max_rows, budget * table.num_rows // max(1, table.nbytes)))
+
+    with pq.ParquetWriter(f'./db/{db_name}_{data_topic}.parquet', schema, compression=chunk_compression or 'snappy') as writer:
+        for record in records:
+            record_bucket = record[chunk_key_columns.get(data_topic, 'id')] // chunk_id_range
+            if not chunks or record_bucket != bucket or chunks[-1]['rows'] == rows:
+                if chunks:
+                    rows = write_row_group()
+                    columns = {name: [] for name in schema.names}
+                bucket, key = chunk_key(record, data_topic, chunk_parts)
+                chunks.append({'key': key, 'rows': 0})
+            for name, column in columns.items():
+                column.append(record[name])
+            chunks[-1]['rows'] += 1
+            count += 1
+        if chunks:
+            write_row_group()
+    chunk_sizes[data_topic] = len(chunks)
+    size, checksum = file_digest(f'./db/{db_name}_{data_topic}.parquet')
+    manifest[data_topic] = {
+        'format': 'parquet',
+        'file': {'file': f'{db_name}_{data_topic}.parquet', 'bytes': size, 'sha256': checksum},
+        'chunks': chunks
+    }
+    return count
+
+def file_digest(path):
+    # Size and sha256 checksum of a file, read in blocks so that large files are not held in memory
+    checksum = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        for block in iter(partial(file.read, 1 << 20), b''):
+            checksum.update(block)
+            size += len(block)
+    return size, checksum.hexdigest()
+
+def remove_stale_chunks(db_name, manifest):
+    # Delete data files of a database that its manifest no longer lists, left by earlier extractions
+    # with more data, other chunk sizes or another format, so that nothing loads them by mistake
+    listed = set()
+    for entry in manifest.values():
+        if entry['format'] == 'parquet':
+            listed.add(entry['file'])
+        elif entry['format'] == 'json':
+            listed.update(chunk['file'] for chunk in entry['chunks'])
+    topics = '|'.join(re.escape(topic) for topic in manifest)
+    chunk_file = re.compile(rf'{re.escape(db_name)}_({topics})(_[0-9-]+\.json(\.gz)?|\.parquet)')
+    removed = 0
+    for name in os.listdir('./db'):
+        if chunk_file.fullmatch(name) and name not in listed:
+            os.remove(f'./db/{name}')
+            removed += 1
+    if removed:
+        print(f'    Removed {removed} stale data files of {db_name}.')
+
+def verify_manifest(db_name, manifest):
+    # Check every data file against the manifest written when it was extracted.
+    # Returns the number of records per topic and a list of problems found.
+    counts = {}
+    problems = []
+    for topic, entry in manifest.items():
+        counts[topic] = sum(chunk['rows'] for chunk in entry['chunks'])
+        if entry['format'] == 'memory':
+            if any((db_name, topic, chunk['key']) not in memory_chunks for chunk in entry['chunks']):
+                problems.append(f'{topic} was kept in memory by another run, extract it again')
+            continue
+        files = [entry['file']] if entry['format'] == 'parquet' else entry['chunks']
+        for chunk in files:
+            try:
+                size, checksum = file_digest(f'./db/{chunk["file"]}')
+            except FileNotFoundError:
+                problems.append(f'{chunk["file"]} is missing')
+                continue
+            if size != chunk['bytes']:
+                problems.append(f'{chunk["file"]} has {size} bytes, expected {chunk["bytes"]}')
+            elif checksum != chunk['sha256']:
+                problems.append(f'{chunk["file"]} does not match its checksum')
+    return counts, problems
+
+def chunk_keys(platform, topic):
+    # Keys of the chunks of a topic. Data extracted before manifests were written has numbered chunks.
+    manifest = platform.get('manifest')
+    if not manifest:
+        return list(range(1, platform['stats']['chunk_sizes'][topic] + 1))
+    return [chunk['key'] for chunk in manifest[topic]['chunks']]
+
+# JSON chunks are read by APOC on the Neo4j server, which must have access to the data directory,
+# or read here and sent as parameters over Bolt, so that Neo4j can run on another host.
+loader_transport = config.get('loader_transport', 'apoc')
+
+def chunk_records(platform, topic, chunk):
+    # Read the records of a chunk here, in any format. Parquet row groups are read from a memory map,
+    # with timestamps as strings like in the JSON chunks.
+    dataset = platform['site']['name']
+    if platform['stats'].get('chunk_format') == 'memory':
+        return memory_chunks[(dataset, topic, chunk)]
+    if platform['stats'].get('chunk_format') == 'parquet' and topic in parquet_topics:
+        parquet_file = pq.ParquetFile(f'{data_path}/{dataset}_{topic}.parquet', memory_map=True)
+        table = parquet_file.read_row_group(chunk_keys(platform, topic).index(chunk))
+        timestamps = [field.name for field in table.schema if pa.types.is_timestamp(field.type)]
+        rows = table.to_pylist()
+        for row in rows:
+            for name in timestamps:
+                if row[name] is not None:
+                    row[name] = str(row[name])
+        return rows
+    if platform['stats'].get('chunk_compression') == 'gzip':
+        with gzip.open(f'{data_path}/{dataset}_{topic}_{chunk}.json.gz', 'rt', encoding='utf-8') as file:
+            return json.load(file)
+    with open(f'{data_path}/{dataset}_{topic}_{chunk}.json', encoding='utf-8') as file:
+        return json.load(file)
+
+def topic_records(platform, topic):
+    # All records of a topic, a chunk at a time
+    for chunk in chunk_keys(platform, topic):
+        yield from chunk_records(platform, topic, chunk)
+
+def apoc_loaded(platform, topic):
+    # Whether the chunks of a topic are JSON files that APOC reads
+    chunk_format = platform['stats'].get('chunk_format')
+    return not (loader_transport == 'bolt' or chunk_format == 'memory' or (chunk_format == 'parquet' and topic in parquet_topics))
+
+def read_chunk(platform, topic, chunk):
+    # Return the Cypher clause that yields the records of a chunk as value, and its parameters.
+    # JSON chunk files are read by APOC from the data directory, unless the transport is Bolt.
+    # Other chunks are read here and passed as rows.
+    dataset = platform['site']['name']
+    if not apoc_loaded(platform, topic):
+        return 'UNWIND $rows AS value', {'rows': chunk_records(platform, topic, chunk)}
+    if platform['stats'].get('chunk_compression') == 'gzip':
+        return f'CALL apoc.load.json("file://{data_path}/{dataset}_{topic}_{chunk}.json.gz", "", {{compression: "GZIP"}}) YIELD value', {}
+    return f'CALL apoc.load.json("file://{data_path}/{dataset}_{topic}_{chunk}.json") YIELD value', {}
+
+def count_rows(db_name, topic, chunks, chunk_format):
+    # Count the records of a topic in the data files
+    if chunk_format == 'parquet' and topic in parquet_topics:
+        return pq.ParquetFile(f'./db/{db_name}_{topic}.parquet', memory_map=True).metadata.num_rows
+    count = 0
+    for chunk in range(1, chunks + 1):
+        with open(f'./db/{db_name}_{topic}_{chunk}.json') as file:
+            count += len(json.load(file))
+    return count
+
+def load_watermarks(db_name):
+    # Watermarks are only committed after a completed graph build, see commit_watermarks.
+    try:
+        with open(f'./db/{db_name}_watermarks.json') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def commit_watermarks(dbs):
+    # Promote the watermarks of the data that has now been loaded into the graph
+    for db in dbs:
+        pending = f'./db/{db["name"]}_watermarks_pending.json'
+        if os.path.exists(pending):
+            os.replace(pending, f'./db/{db["name"]}_watermarks.json')
+
+def commit_loaded_chunks(data):
+    # Record the content of the chunks now in the graph, so incremental imports can skip them.
+    # A full build replaces the record, an incremental one adds to it. Failed chunks are left out.
+    for name, platform in data.items():
+        manifest = platform.get('manifest')
+        if not manifest:
+            continue
+        loaded = platform['loaded'] if platform['stats'].get('incremental') else {}
+        for topic in manifest:
+            contents = loaded.setdefault(topic, {})
+            for key, content in chunk_contents(platform, topic).items():
+                if content is None or (platform['site']['name'], topic, key) in failed_chunks:
+                    contents.pop(key, None)
+                else:
+                    contents[key] = content
+        with open(f'./db/{name}_loaded.json', 'w') as file:
+            json.dump(loaded, file)
+
+# Threads used to hash emails that are not in the cache yet
+hashing_workers = config.get('hashing_workers', os.cpu_count())
+
+def load_salt(db_path):
+    # Salt for hashing redacted data that is needed for matching, like user emails.
+    # The salt is kept between runs so that the same email always gives the same hash,
+    # which incremental imports need to match existing global users.
+    salt_path = f'{db_path}/salt'
+    if os.path.exists(salt_path):
+        with open(salt_path, 'rb') as file:
+            return file.read()
+    salt = os.urandom(32)
+    with open(salt_path, 'wb') as file:
+        file.write(salt)
+    return salt
+
+def load_email_hashes(db_path, salt):
+    # The cache maps a keyed digest of each email to its hash, so no plain text emails are stored.
+    # A cache made with another salt is discarded.
+    salt_id = hashlib.sha256(salt).hexdigest()[:16]
+    try:
+        with open(f'{db_path}/email_hashes.json') as file:
+            cache = json.load(file)
+    except FileNotFoundError:
+        return {}
+    if cache.get('salt_id') != salt_id:
+        print('Email hash cache was made with another salt and is discarded.')
+        return {}
+    return cache['hashes']
+
+def save_email_hashes(db_path, salt, email_hashes):
+    with open(f'{db_path}/email_hashes.json', 'w') as file:
+        json.dump({'salt_id': hashlib.sha256(salt).hexdigest()[:16], 'hashes': email_hashes}, file)
+
+def hash_email(email, salt):
+    # A fixed width hex id of 32 characters, compact enough to index global users by
+    return hashlib.pbkdf2_hmac(
+        'sha256',
+        email.encode('utf-8'),
+        salt,
+        1000,
+        dklen=16
+    ).hex()
+
+def hash_emails(emails, salt, email_hashes):
+    # Return the hash of each email, computing only those that are not cached.
+    # Emails are normalized so the same address gives the same hash on every platform.
+    # Computed hashes are added to the cache and also returned separately,
+    # so that worker processes can pass them back to be saved.
+    hashes = {}
+    misses = {}
+    for email in emails:
+        normalized = email.strip().lower()
+        cache_key = hmac.new(salt, normalized.encode('utf-8'), 'sha256').hexdigest()
+        if cache_key in email_hashes:
+            hashes[email] = email_hashes[cache_key]
+        else:
+            misses.setdefault(cache_key, (normalized, []))[1].append(email)
+    # hashlib releases the GIL while hashing, so threads hash in parallel
+    with ThreadPoolExecutor(max_workers=hashing_workers) as executor:
+        computed = dict(zip(misses.keys(), executor.map(partial(hash_email, salt=salt), [normalized for normalized, _ in misses.values()])))
+    for cache_key, (normalized, originals) in misses.items():
+        for email in originals:
+            hashes[email] = computed[cache_key]
+    email_hashes.update(computed)
+    return hashes, computed
+
+def get_data(pool, db_name, db_root, salt, email_hashes, watermarks):
     # This function gets the data we need from the Discourse psql database.
     # It assumes that the database is built from backup dumps. 
     # If running on the live database, 'backup' in the database names should be changed.
     # TODO: make the database name into a variable to enable loading from backup or live db
+    # If watermarks are given, only users, topics, posts, likes, replies, quotes and annotations
+    # changed since the watermark are returned. Small tables are always loaded in full.
+    # Data is written to chunk files as it is extracted, and only stats are returned.
+    # Independent queries run concurrently on the connections of the pool, which share one snapshot.
+
+    delta = bool(watermarks)
+    new_watermarks = dict(watermarks)
+    chunk_sizes = {}
+    manifest = {}
+    # Chunks that are unchanged since the last extraction are not written again
+    previous = load_manifest(db_name) or {}
+    omit = omit_conditions(db_root)
+
+    if delta:
+        print(f'Loading changed data from {db_name}')
+    else:
+        print(f'Loading new data from {db_name}')
 
-    print(f'Loading new data from {db_name}')
-
-    # Get site data
+    # Site data
 
     site_query = f'''
     SELECT 
@@ -39,21 +837,31 @@ def get_data(db_cursor, db_name, db_root, salt):
     LIMIT 1 
     '''
 
-    db_cursor.execute(site_query)
-    site_data = db_cursor.fetchall()
-    site = {
-        'name': db_name,
-        'url': site_data[0][0]
-    }
-    print(f'    Loading data from {site["url"]} database...')
+    # Users, consent, group memberships
 
-    # Get users, consent, group memberships
+    # Consent and group membership changes do not touch users.updated_at
+    users_delta = None
+    if 'users' in watermarks:
+        users_delta = f'''
+        users.updated_at >= %(users)s
+        OR users.id IN (SELECT user_id FROM {db_root}.user_custom_fields WHERE name = 'edgeryders_consent' AND updated_at >= %(users)s)
+        OR users.id IN (SELECT user_id FROM {db_root}.group_users WHERE updated_at >= %(users)s)
+        '''
 
     users_query = f'''
     SELECT
-    users.id, username_lower, email
+    users.id, username_lower, email, users.updated_at
+    FROM {db_root}.users AS users, {db_root}.user_emails as emails
+    {where('users.id = emails.user_id', users_delta, *omit['users'])}
+    ORDER BY users.id
+    '''
+
+    # All user ids, including omitted system users and users unchanged since the last import
+    user_ids_query = f'''
+    SELECT
+    users.id
     FROM {db_root}.users AS users, {db_root}.user_emails as emails
-    WHERE users.id = emails.user_id;
+    WHERE users.id = emails.user_id
     '''
 
     consent_query = f'''
@@ -69,25 +877,180 @@ def get_data(db_cursor, db_name, db_root, salt):
     FROM {db_root}.group_users
     '''
 
+    # Groups
+
+    groups_query = f'''
+    SELECT 
+    id, name, visibility_level 
+    FROM {db_root}.groups
+    {where(*omit['groups'])}
+    ORDER BY id
+    '''
+
+    # Categories
+
+    categories_query = f'''
+    SELECT
+    id, name, name_lower, created_at, updated_at, read_restricted, parent_category_id
+    FROM {db_root}.categories
+    {where(*omit['categories'])}
+    ORDER BY id
+    '''
+
+    categories_permissions = f'''
+    SELECT
+    id, category_id, group_id, permission_type
+    FROM {db_root}.category_groups
+    {where(*omit['category_groups'])}
+    '''
+
+    # Tags
+
+    tags_query = f'''
+    SELECT
+    id, name, topic_count, created_at, updated_at
+    FROM {db_root}.tags
+    ORDER BY id
+    '''
+
+    # Topics, permissions, topic tags
+
+    # Tagging a topic does not touch topics.updated_at
+    topics_delta = None
+    if 'topics' in watermarks:
+        topics_delta = f'''
+        topics.updated_at >= %(topics)s
+        OR topics.id IN (SELECT topic_id FROM {db_root}.topic_tags WHERE updated_at >= %(topics)s)
+        '''
+
+    topics_query = f'''
+    SELECT
+    id, title, created_at, updated_at, user_id, category_id
+    FROM {db_root}.topics
+    {where(topics_delta, *omit['topics'])}
+    ORDER BY id
+    '''
+
+    # In incremental mode, topics and posts that are omitted now, or deleted, may have been loaded by an earlier
+    # import, without a change of their own, as when their category becomes read restricted. The ids of all
+    # those that are visible now are read, and the graph keeps only these.
+    visible_topics_query = f'''
+    SELECT
+    id
+    FROM {db_root}.topics AS topics
+    {where(*omit['topics'])}
+    '''
+
+    visible_posts_query = f'''
+    SELECT
+    id
+    FROM {db_root}.posts AS posts
+    {where(*omit['posts'])}
+    '''
+
+    # Private message posts are counted for the stats, although they are not extracted
+    messages_query = f'''
+    SELECT
+    count(*)
+    FROM {db_root}.posts AS posts
+    {where(delta_condition(watermarks, 'posts'), f'posts.topic_id IN (SELECT topic_id FROM {db_root}.topic_allowed_users)')}
+    '''
+
+    topic_categories_query = f'''
+    SELECT
+    id, category_id
+    FROM {db_root}.topics
+    '''
+
+    allowed_users_query = f'''
+    SELECT 
+    topic_id, user_id
+    FROM {db_root}.topic_allowed_users
+    '''
+
+    topic_tags_query = f'''
+    SELECT
+    topic_id, tag_id
+    FROM {db_root}.topic_tags
+    '''
+
+    # Annotator languages, codes and code names
+
+    annotator_languages_query = f'''
+    SELECT
+    id, name, locale
+    FROM {db_root}.annotator_store_languages
+    ORDER BY id
+    '''
+
+    annotator_codes_query = f'''
+    SELECT
+    id, description, creator_id, created_at, updated_at, ancestry, annotations_count
+    FROM {db_root}.annotator_store_tags
+    ORDER BY id
+    '''
+
+    annotator_code_names_query = f'''
+    SELECT
+    id, name, tag_id, language_id, created_at
+    FROM {db_root}.annotator_store_tag_names
+    ORDER BY id
+    '''
+
+    # None of these queries depend on each other, so they all run at once.
+    # Records are built from the results once they have all arrived.
+    queries = {
+        'site': (site_query, None),
+        'users': (users_query, watermarks),
+        'consent': (consent_query, None),
+        'group_members': (group_members_query, None),
+        'groups': (groups_query, None),
+        'categories': (categories_query, None),
+        'category_permissions': (categories_permissions, None),
+        'tags': (tags_query, None),
+        'topics': (topics_query, watermarks),
+        'messages': (messages_query, watermarks),
+        'allowed_users': (allowed_users_query, None),
+        'topic_tags': (topic_tags_query, None),
+        'languages': (annotator_languages_query, None),
+        'codes': (annotator_codes_query, None),
+        'code_names': (annotator_code_names_query, None),
+        'user_ids': (user_ids_query, None)
+    }
+    if delta:
+        queries['topic_categories'] = (topic_categories_query, None)
+        queries['visible_topics'] = (visible_topics_query, None)
+        queries['visible_posts'] = (visible_posts_query, None)
+
+    results = run_concurrently(pool, {
+        name: partial(fetch_all, pool, query, params) for name, (query, params) in queries.items()
+    })
+
+    # Get site data
+
+    site_data = results['site']
+    site = {
+        'name': db_name,
+        'url': site_data[0][0]
+    }
+    print(f'    Loading data from {site["url"]} database...')
+
+    # Get users, consent, group memberships
+
     users = {}
-    db_cursor.execute(users_query)
-    users_data = db_cursor.fetchall()
+    users_data = results['users']
     # If emails are redacted, we use a salted hash to link user accounts together
     # Since we need the same email to return the same hash, we use one salt for all platforms and users. 
+    new_email_hashes = {}
     if config['redact_emails']:
         print(f'    Redacting emails and replacing with hashes...')
-    for user in users_data:
+        hashed_emails, new_email_hashes = hash_emails([user[2] for user in users_data], salt, email_hashes)
+        print(f'    Hashed {len(new_email_hashes)} new emails, {len(users_data) - len(new_email_hashes)} were cached.')
+    for user in track_watermark(users_data, new_watermarks, 'users', 3):
         uid = user[0]
         email = user[2]
-        hashed_email = hashlib.pbkdf2_hmac(
-            'sha256',
-            email.encode('utf-8'),
-            salt,
-            1000,
-            dklen=128
-        )
         if config['redact_emails']:
-            email = hashed_email
+            email = hashed_emails[email]
         users[uid] = {
             'id': uid,
             'username': user[1],
@@ -98,41 +1061,39 @@ def get_data(db_cursor, db_name, db_root, salt):
         }
     
     # Adding another system user as a dummy user for private and deleted content
-    users[-100] = {
-        'id': -100,
-        'username': "Unknown",
-        'email': "Unknown",
-        'groups': [],
-        'consent': 0,
-        'consent_updated': 0
-    }
+    if not omit_system_users:
+        users[-100] = {
+            'id': -100,
+            'username': "Unknown",
+            'email': "Unknown",
+            'groups': [],
+            'consent': 0,
+            'consent_updated': 0
+        }
 
-    db_cursor.execute(consent_query)
-    consent_data = db_cursor.fetchall()
+    consent_data = results['consent']
     for user in consent_data:
         uid = user[0]
-        users[uid]['consent'] = user[1]
-        users[uid]['consent_updated'] = user[2]
+        if uid in users:
+            users[uid]['consent'] = user[1]
+            users[uid]['consent_updated'] = user[2]
 
-    db_cursor.execute(group_members_query)
-    group_members_data = db_cursor.fetchall()
+    group_members_data = results['group_members']
     for group_member in group_members_data:
         uid = group_member[1]
-        users[uid]['groups'].append(group_member[0])
+        if uid in users:
+            users[uid]['groups'].append(group_member[0])
+
+    # Content is attributed to the dummy user if its creator is not a known user.
+    # Omitted system users and, in incremental mode, unchanged users are not extracted, so we look up all user ids.
+    user_ids = IdSet(user[0] for user in results.pop('user_ids'))
 
     print(f'    Got {len(users.keys())} users')
 
     # Get groups
 
-    groups_query = f'''
-    SELECT 
-    id, name, visibility_level 
-    FROM {db_root}.groups
-    '''
-
     groups = {}
-    db_cursor.execute(groups_query)
-    group_data = db_cursor.fetchall()
+    group_data = results['groups']
     for group in group_data:
         gid = group[0]
         groups[gid] = {
@@ -145,21 +1106,8 @@ def get_data(db_cursor, db_name, db_root, salt):
 
     # Get categories
 
-    categories_query = f'''
-    SELECT
-    id, name, name_lower, created_at, updated_at, read_restricted, parent_category_id
-    FROM {db_root}.categories
-    '''
-
-    categories_permissions = f'''
-    SELECT
-    id, category_id, group_id, permission_type
-    FROM {db_root}.category_groups
-    '''
-
     categories = {}
-    db_cursor.execute(categories_query)
-    category_data = db_cursor.fetchall()
+    category_data = results['categories']
     for category in category_data:
         cid = category[0]
         categories[cid] = {
@@ -174,8 +1122,7 @@ def get_data(db_cursor, db_name, db_root, salt):
         }
 
     # Group 0 is 'everyone' and permission_type is an integer 1 = Full 2 = Reply and read 3 = Read Only
-    db_cursor.execute(categories_permissions)
-    category_permission_data = db_cursor.fetchall()
+    category_permission_data = results['category_permissions']
     for permission in category_permission_data:
         cid = permission[1]
         categories[cid]['permissions'].append(permission[2])
@@ -184,15 +1131,8 @@ def get_data(db_cursor, db_name, db_root, salt):
 
     # Get tags
 
-    tags_query = f'''
-    SELECT
-    id, name, topic_count, created_at, updated_at
-    FROM {db_root}.tags
-    '''
-
     tags = {}
-    db_cursor.execute(tags_query)
-    tags_data = db_cursor.fetchall()
+    tags_data = results['tags']
     for tag in tags_data:
         tid = tag [0]
         tags[tid] = {
@@ -206,182 +1146,244 @@ def get_data(db_cursor, db_name, db_root, salt):
     print(f'    Got {len(tags.keys())} tags.')
 
     # Get topics, permissions, topic tags
-    # Private messages are excluded
-
-    topics_query = f'''
-    SELECT
-    id, title, created_at, updated_at, user_id, category_id
-    FROM {db_root}.topics
-    '''
-
-    allowed_users_query = f'''
-    SELECT 
-    topic_id, user_id
-    FROM {db_root}.topic_allowed_users
-    '''
 
-    topic_tags_query = f'''
-    SELECT
-    topic_id, tag_id
-    FROM {db_root}.topic_tags
-    '''
+    allowed_users_data = results.pop('allowed_users')
+    pm_count = len(allowed_users_data)
+    pm_topic_set = IdSet(set(permission[0] for permission in allowed_users_data))
 
-    pm_count = 0
-    pm_topic_set = set()
-    db_cursor.execute(allowed_users_query)
-    allowed_users_data = db_cursor.fetchall()
-    for permission in allowed_users_data:
-        tid = permission[0]
-        pm_topic_set.add(tid)
-        pm_count += 1
+    def topic_read_restricted(tid, category_id):
+        cid = category_id if category_id in categories.keys() else None
+        return True if tid in pm_topic_set or not cid else categories[cid]['read_restricted']
 
     topics = {}
-    db_cursor.execute(topics_query)
-    topics_data = db_cursor.fetchall()
+    topics_data = results['topics']
     lost_topics = set()
-    for topic in topics_data:
+    for topic in track_watermark(topics_data, new_watermarks, 'topics', 3):
         tid = topic[0]
         cid = topic[5] if topic[5] in categories.keys() else None
-        read_restricted = True if tid in pm_topic_set or not cid else categories[cid]['read_restricted']
+        read_restricted = topic_read_restricted(tid, topic[5])
         topics[tid] = {
             'id': tid,
             'title': 'Private message' if tid in pm_topic_set else topic[1],
             'created_at': topic[2],
             'updated_at': topic[3],
-            'user_id': -100 if tid in pm_topic_set or topic[4] not in users.keys() else topic[4],
+            'user_id': -100 if tid in pm_topic_set or topic[4] not in user_ids else topic[4],
             'is_message_thread': True if tid in pm_topic_set else False,
             'category_id': cid,
             'read_restricted': read_restricted,
             'allowed_users': [],
             'tags': []
         }
-        if topic[4] not in users.keys():
+        if topic[4] not in user_ids:
             lost_topics.add(tid)
 
-    db_cursor.execute(topic_tags_query)
-    topic_tags_data = db_cursor.fetchall()
+    # Posts inherit read restrictions from their topic, which may be unchanged in incremental mode.
+    # Posts in topics that are not known are read restricted.
+    if delta:
+        open_topics = IdSet(topic[0] for topic in results.pop('topic_categories') if not topic_read_restricted(topic[0], topic[1]))
+    else:
+        open_topics = IdSet(tid for tid, topic in topics.items() if not topic['read_restricted'])
+
+    topic_tags_data = results['topic_tags']
     for tag in topic_tags_data:
         tid = tag[0]
-        topics[tid]['tags'].append(tag[1])
+        if tid in topics:
+            topics[tid]['tags'].append(tag[1])
 
     print(f'    Got {len(topics.keys())} topics and applied {len(topic_tags_data)} tags.')
 
+    # In incremental mode, groups, categories, topics and posts that are omitted or deleted now may have been
+    # loaded by an earlier import, so the ids of all visible ones are listed, and the graph keeps only these.
+    # Removed group memberships and topic tags leave no trace to find them by, so all current ones are
+    # listed, by group and by tag, and the links of the graph that are not among them are removed.
+    removed = {
+        'visible': None,
+        'group_members': [],
+        'tag_topics': []
+    }
+    if delta:
+        removed['visible'] = {
+            'groups': sorted(groups),
+            'categories': sorted(categories),
+            'topics': sorted(topic[0] for topic in results.pop('visible_topics')),
+            'posts': sorted(post[0] for post in results.pop('visible_posts'))
+        }
+        group_members = {gid: [] for gid in groups}
+        for group_member in group_members_data:
+            if group_member[0] in group_members:
+                group_members[group_member[0]].append(group_member[1])
+        tag_topics = {tid: [] for tid in tags}
+        for tag in topic_tags_data:
+            if tag[1] in tag_topics:
+                tag_topics[tag[1]].append(tag[0])
+        removed['group_members'] = [{'id': gid, 'users': uids} for gid, uids in group_members.items()]
+        removed['tag_topics'] = [{'id': tid, 'topics': topic_ids} for tid, topic_ids in tag_topics.items()]
+
+    dump_chunks(users.values(), db_name, 'users', chunk_sizes, manifest, previous)
+    dump_chunks(groups.values(), db_name, 'groups', chunk_sizes, manifest, previous)
+    dump_chunks(tags.values(), db_name, 'tags', chunk_sizes, manifest, previous)
+    dump_chunks(categories.values(), db_name, 'categories', chunk_sizes, manifest, previous)
+    dump_chunks(topics.values(), db_name, 'topics', chunk_sizes, manifest, previous)
+
     # Get posts
-    # Private messages are excluded
+    # Posts are streamed from the database and written to files as they arrive.
+    # Lists of quoted posts, replies and likes per post are aggregated in the query.
+    # Omitted posts, quotes, likes and annotations are filtered out in the queries.
 
     posts_query = f'''
     SELECT
-    id, user_id, topic_id, post_number, raw, created_at, updated_at, deleted_at, hidden, word_count, wiki, reads, score, like_count, reply_count, quote_count
-    FROM {db_root}.posts
+    posts.id, user_id, topic_id, post_number, raw, created_at, updated_at, deleted_at, hidden, word_count, wiki, reads, score, like_count, reply_count, quote_count,
+    ARRAY(SELECT quoted_post_id FROM {db_root}.quoted_posts WHERE post_id = posts.id),
+    ARRAY(SELECT post_id FROM {db_root}.post_replies WHERE reply_post_id = posts.id),
+    ARRAY(SELECT user_id FROM {db_root}.post_actions WHERE post_id = posts.id AND post_action_type_id = 2)
+    FROM {db_root}.posts AS posts
+    {where(delta_condition(watermarks, 'posts', column='posts.updated_at'), *omit['posts'])}
+    ORDER BY posts.id
     '''
 
+    posts_types = [
+        int, int, int, int, copy_text, copy_timestamp, copy_timestamp, copy_timestamp, copy_bool,
+        int, copy_bool, int, float, int, int, int, copy_int_array, copy_int_array, copy_int_array
+    ]
+
     replies_query = f'''
     SELECT
-    post_id, reply_post_id
+    post_id, reply_post_id, updated_at
     FROM {db_root}.post_replies
+    {where(delta_condition(watermarks, 'post_replies'))}
+    ORDER BY post_id
     '''
 
     quotes_query = f'''
     SELECT
-    post_id, quoted_post_id
-    FROM {db_root}.quoted_posts
+    post_id, quoted_post_id, updated_at
+    FROM {db_root}.quoted_posts AS quoted_posts
+    {where(delta_condition(watermarks, 'quoted_posts', column='quoted_posts.updated_at'), *omit['quotes'])}
+    ORDER BY quoted_posts.post_id
     '''
 
     likes_query = f'''
     SELECT
-    post_id, user_id
-    FROM {db_root}.post_actions
-    WHERE post_action_type_id = 2
+    post_id, user_id, updated_at
+    FROM {db_root}.post_actions AS post_actions
+    {where('post_actions.post_action_type_id = 2', delta_condition(watermarks, 'post_actions', column='post_actions.updated_at'), *omit['likes'])}
+    ORDER BY post_actions.post_id
     '''
 
-    posts = {}
-    pm_post_set = set()
-    private_count = 0
-    db_cursor.execute(posts_query)
-    posts_data = db_cursor.fetchall()
-    for post in posts_data:
-        pid = post[0]
-        tid = post[2]
-        private = True if post[2] in pm_topic_set else False
-        read_restricted = True if tid not in topics.keys() else topics[tid]['read_restricted']
-        if private:
-            pm_post_set.add(pid)
-            private_count += 1
-        deleted = post[7]
-        posts[pid] = {
-            'id': pid,
-            'user_id': -100 if private or deleted or post[1] not in users.keys() else post[1],
-            'topic_id': tid,
-            'post_number': post[3],
-            'raw': 'Removed content' if private or deleted else post[4],
-            'created_at': post[5],
-            'updated_at': post[6],
-            'deleted_at': post[7],
-            'hidden': post[8],
-            'read_restricted': read_restricted,
-            'word_count': 0 if private or deleted else post[9],
-            'wiki': post[10],
-            'reads': 0 if private or deleted else post[11],
-            'score': 0 if private or deleted else post[12],
-            'like_count': 0 if private or deleted else post[13],
-            'reply_count': post[14],
-            'quote_count': post[15],
-            'quotes_posts': [],
-            'is_reply_to': [],
-            'is_liked_by': [],
-            'is_private': private
-        }
+    likes_types = [int, int, copy_timestamp]
+
+    def get_posts():
+        with pooled_connection(pool) as db_conn:
+            for post in track_watermark(extract_query(db_conn, 'posts', posts_query, watermarks, posts_types), new_watermarks, 'posts', 6):
+                pid = post[0]
+                tid = post[2]
+                private = True if post[2] in pm_topic_set else False
+                read_restricted = tid not in open_topics
+                deleted = post[7]
+                raw = 'Removed content' if private or deleted else post[4]
+                yield {
+                    'id': pid,
+                    'user_id': -100 if private or deleted or post[1] not in user_ids else post[1],
+                    'topic_id': tid,
+                    'post_number': post[3],
+                    'raw_excerpt': raw[:raw_excerpt_length],
+                    'raw_length': len(raw),
+                    'raw_hash': store_raw(raw),
+                    'created_at': post[5],
+                    'updated_at': post[6],
+                    'deleted_at': post[7],
+                    'hidden': post[8],
+                    'read_restricted': read_restricted,
+                    'word_count': 0 if private or deleted else post[9],
+                    'wiki': post[10],
+                    'reads': 0 if private or deleted else post[11],
+                    'score': 0 if private or deleted else post[12],
+                    'like_count': 0 if private or deleted else post[13],
+                    'reply_count': post[14],
+                    'quote_count': post[15],
+                    'quotes_posts': post[16],
+                    'is_reply_to': post[17],
+                    'is_liked_by': post[18],
+                    'is_private': private
+                }
+
+    def get_quotes():
+        with pooled_connection(pool) as db_conn:
+            for quote in track_watermark(stream_query(db_conn, 'quotes', quotes_query, watermarks), new_watermarks, 'quoted_posts', 2):
+                yield {
+                    'post_id': quote[0],
+                    'quoted_post_id': quote[1]
+                }
+
+    def get_replies():
+        with pooled_connection(pool) as db_conn:
+            for reply in track_watermark(stream_query(db_conn, 'replies', replies_query, watermarks), new_watermarks, 'post_replies', 2):
+                yield {
+                    'post_id': reply[0],
+                    'reply_post_id': reply[1]
+                }
+
+    def get_likes():
+        with pooled_connection(pool) as db_conn:
+            for like in track_watermark(extract_query(db_conn, 'likes', likes_query, watermarks, likes_types), new_watermarks, 'post_actions', 2):
+                yield {
+                    'post_id': like[0],
+                    'user_id': like[1]
+                }
 
-    quotes = {}
-    db_cursor.execute(quotes_query)
-    quotes_data = db_cursor.fetchall()
-    for num, quote in enumerate(quotes_data):
-        posts[quote[0]]['quotes_posts'].append(quote[1])
-        quotes[num] = {
-            'id': num,
-            'post_id': quote[0],
-            'quoted_post_id': quote[1]
-        }
+    # Get annotator annotations and ranges
 
-    replies = {}
-    db_cursor.execute(replies_query)
-    replies_data = db_cursor.fetchall()
-    for num, reply in enumerate(replies_data):
-        posts[reply[1]]['is_reply_to'].append(reply[0])
-        replies[num] = {
-            'id': num,
-            'post_id': reply[0],
-            'reply_post_id': reply[1]
-        }
+    annotations_query = f'''
+    SELECT
+    id, text, quote, created_at, updated_at, tag_id, post_id, creator_id, type, topic_id
+    FROM {db_root}.annotator_store_annotations AS annotations
+    {where(delta_condition(watermarks, 'annotator_store_annotations', column='annotations.updated_at'), *omit['annotations'])}
+    ORDER BY annotations.id
+    '''
 
-    likes = {}
-    db_cursor.execute(likes_query)
-    likes_data = db_cursor.fetchall()
-    for num, like in enumerate(likes_data):
-        posts[like[0]]['is_liked_by'].append(like[1])
-        likes[num] = {
-            'id': num,
-            'post_id': like[0],
-            'user_id': like[1]
-        }
+    annotations_types = [
+        int, copy_text, copy_text, copy_timestamp, copy_timestamp, int, int, int, copy_text, int
+    ]
+
+    def get_annotations():
+        with pooled_connection(pool) as db_conn:
+            for annotation in track_watermark(extract_query(db_conn, 'annotations', annotations_query, watermarks, annotations_types), new_watermarks, 'annotator_store_annotations', 4):
+                yield {
+                    'id': annotation[0],
+                    'text': annotation[1], 
+                    'quote': annotation[2], 
+                    'created_at': annotation[3],
+                    'updated_at': annotation[4], 
+                    'tag_id': annotation[5],
+                    'post_id': annotation[6], 
+                    'creator_id': annotation[7], 
+                    'type': annotation[8],
+                    'topic_id': annotation[9] 
+                }
+
+    # Omit rules are applied in the queries, so none of the streams depend on each other and all run at once.
+    streams = {
+        'posts': get_posts,
+        'replies': get_replies,
+        'quotes': get_quotes,
+        'likes': get_likes,
+        'annotations': get_annotations
+    }
+    counts = run_concurrently(pool, {
+        topic: partial(dump_chunks, stream(), db_name, topic, chunk_sizes, manifest, previous) for topic, stream in streams.items()
+    })
 
-    print(f'    Got {len(posts.keys())} posts.')
-    print(f'    Got {len(replies.keys())} replies.')
-    print(f'    Got {len(quotes.keys())} quotes.')
-    print(f'    Got {len(likes.keys())} likes.')
+    print(f'    Got {counts["posts"]} posts.')
+    print(f'    Got {counts["replies"]} replies.')
+    print(f'    Got {counts["quotes"]} quotes.')
+    print(f'    Got {counts["likes"]} likes.')
+    print(f'    Got {counts["annotations"]} annotations.')
 
     # Get annotator languages
 
-    annotator_languages_query = f'''
-    SELECT
-    id, name, locale
-    FROM {db_root}.annotator_store_languages
-    '''
-
     annotator_languages = {}
     language_list = ''
-    db_cursor.execute(annotator_languages_query)
-    annotator_languages_data = db_cursor.fetchall()
+    annotator_languages_data = results['languages']
     for language in annotator_languages_data:
         lid = language[0]
         annotator_languages[lid] = {
@@ -395,21 +1397,8 @@ def get_data(db_cursor, db_name, db_root, salt):
 
     # Get annotator codes and code names
 
-    annotator_codes_query = f'''
-    SELECT
-    id, description, creator_id, created_at, updated_at, ancestry, annotations_count
-    FROM {db_root}.annotator_store_tags
-    '''
-
-    annotator_code_names_query = f'''
-    SELECT
-    id, name, tag_id, language_id, created_at
-    FROM {db_root}.annotator_store_tag_names
-    '''
-
     annotator_codes = {}
-    db_cursor.execute(annotator_codes_query)
-    annotator_codes_data = db_cursor.fetchall()
+    annotator_codes_data = results['codes']
     for code in annotator_codes_data:
         cid = code[0]
         annotator_codes[cid] = {
@@ -423,8 +1412,7 @@ def get_data(db_cursor, db_name, db_root, salt):
         }
 
     annotator_code_names = {}
-    db_cursor.execute(annotator_code_names_query)
-    annotator_code_names_data = db_cursor.fetchall()
+    annotator_code_names_data = results['code_names']
     for name in annotator_code_names_data:
         nid = name[0]
         annotator_code_names[nid] = {
@@ -437,147 +1425,19 @@ def get_data(db_cursor, db_name, db_root, salt):
 
     print(f'    Got {len(list(annotator_codes.keys()))} codes with {len(list(annotator_code_names.keys()))} names.')
 
-    # Get annotator annotations and ranges
-
-    annotations_query = f'''
-    SELECT
-    id, text, quote, created_at, updated_at, tag_id, post_id, creator_id, type, topic_id
-    FROM {db_root}.annotator_store_annotations
-    '''
-
-    annotations = {}
-    db_cursor.execute(annotations_query)
-    annotations_data = db_cursor.fetchall()
-    for annotation in annotations_data:
-        aid = annotation[0]
-        annotations[aid] = {
-            'id': aid,
-            'text': annotation[1], 
-            'quote': annotation[2], 
-            'created_at': annotation[3],
-            'updated_at': annotation[4], 
-            'tag_id': annotation[5],
-            'post_id': annotation[6], 
-            'creator_id': annotation[7], 
-            'type': annotation[8],
-            'topic_id': annotation[9] 
-        }
-
-    print(f'    Got {len(list(annotations.keys()))} annotations.')
-
-    # Omit data
-    # We accept the redundancy and inefficency of looping through the data
-    # and removing records as this makes the code less complicated
-    # and makes it easier to add new rules later for how and when to omit data
-    # TODO: Move these bools to a config file
-    
-    omit_private_messages = True
-    # Omit private messages from the graph
-
-    omit_protected_content = True
-    # Omit protected content (posts, categories, groups) from the graph.
-    # Content that is not readable by all logged in users is considered protected.
-    # This also omits 'hidden' posts, also known as 'whispers'.
-    # In the future, we may want to handle 'hidden' posts separately if we 
-    # if we want to give access to the graph based on the permissions of a loggen in user.
-
-    omit_system_users = True
-    # This omits content created by system users and by deleted users.
-    # It also omits those users completely from the graph.
-
-    omit = True if omit_private_messages or omit_protected_content or omit_system_users else False
-
-    if omit:
-
-        new = dict(users)
-        for u, d in users.items():
-            if omit_system_users and d['id'] < 0:
-                del(new[u])
-                continue
-        users = new
-
-        new = dict(groups)
-        # Group visibility levels, public=0, logged_on_users=1, members=2, staff=3, owners=4
-        for g, d in groups.items():
-            if omit_protected_content and d['visibility_level'] > 1:
-                del(new[g])
-                continue
-        groups = new
-
-        new = dict(categories)
-        for c, d in categories.items():
-            if omit_protected_content and d['read_restricted']:
-                del(new[c])
-                continue
-            for group in d['permissions']:
-                if group not in groups.keys():
-                    new[c]['permissions'].remove(group)
-        categories = new
-
-        new = dict(topics)
-        for t, d in topics.items():
-            if omit_private_messages and t in pm_topic_set:
-                del(new[t])
-                continue
-            if omit_protected_content and d['read_restricted']:
-                del(new[t])
-                continue
-        topics = new
-
-        new = dict(posts)
-        for p, d in posts.items():
-            if omit_private_messages and p in pm_post_set:
-                del(new[p])
-                continue
-            if omit_protected_content and (d['read_restricted'] or d['hidden']):
-                del(new[p])
-                continue
-        posts = new
-
-        new = dict(quotes)
-        for q, d in quotes.items():
-            if omit_private_messages and (d['quoted_post_id'] in pm_post_set or d['post_id'] in pm_post_set):
-                del(new[q])
-                continue
-            if omit_protected_content and (d['quoted_post_id'] in pm_post_set or d['post_id'] not in posts.keys()):
-                del(new[q])
-                continue
-        quotes = new
-        
-        new = dict(likes)
-        for l, d in likes.items():
-            if omit_private_messages and d['post_id'] in pm_post_set:
-                del(new[l])
-                continue
-            if omit_protected_content and d['post_id'] not in posts.keys():
-                del(new[l])
-                continue
-        likes = new
-
-        new = dict(annotations)
-        for a, d in annotations.items():
-            if omit_private_messages and d['post_id'] in pm_post_set:
-                del(new[a])
-                continue
-            if omit_protected_content and d['post_id'] not in posts.keys():
-                del(new[a])
-                continue
-        annotations = new
-
-        if omit_private_messages:
-            print('Omitted private messages.')
-        if omit_protected_content:
-            print('Omitted protected content.')
-        if omit_system_users:
-            print('Omitted system users and content.')
+    dump_chunks(annotator_languages.values(), db_name, 'languages', chunk_sizes, manifest, previous)
+    dump_chunks(annotator_codes.values(), db_name, 'codes', chunk_sizes, manifest, previous)
+    dump_chunks(annotator_code_names.values(), db_name, 'code_names', chunk_sizes, manifest, previous)
 
+    if omit_private_messages:
+        print('Omitted private messages.')
     if omit_protected_content:
-        pass
-
+        print('Omitted protected content.')
     if omit_system_users:
-        pass
-    
+        print('Omitted system users and content.')
+
     stats = {
+        'incremental': delta,
         'omit_pm': omit_private_messages,
         'omit_protected': omit_protected_content,
         'omit_system_users': omit_system_users,
@@ -589,38 +1449,50 @@ def get_data(db_cursor, db_name, db_root, salt):
         'pm_threads': pm_count,
         'topics_by_deleted_users': len(lost_topics),
         'tags_applied': len(topic_tags_data),
-        'posts': len(posts.keys()),
-        'messages': private_count,
+        'posts': counts['posts'],
+        'messages': results['messages'][0][0],
         'annotator_languages': language_list[:-1],
         'annotator-codes': len(list(annotator_codes.keys())),
         'annotator-code-names': len(list(annotator_code_names.keys())),
-        'annotator-annotations': len(list(annotations.keys()))
+        'annotator-annotations': counts['annotations'],
+        'chunk_format': intermediate_format,
+        'chunk_compression': chunk_compression,
+        'chunk_sizes': chunk_sizes
     }
 
     return {
         'stats': stats,
         'site': site,
-        'users': users,
-        'groups': groups,
-        'tags': tags,
-        'categories': categories,
-        'topics': topics,
-        'posts': posts,
-        'replies': replies,
-        'quotes': quotes,
-        'likes': likes,
-        'languages': annotator_languages,
-        'codes': annotator_codes,
-        'code_names': annotator_code_names,
-        'annotations': annotations
+        'removed': removed,
+        'watermarks': new_watermarks,
+        'manifest': manifest,
+        'email_hashes': new_email_hashes
     }
 
+def reload_database(db, salt, email_hashes):
+    # Extract a single database to chunk files and return its stats.
+    # Runs in a worker process when databases are extracted in parallel.
+
+    pool = open_snapshot_pool(db, connections)
+
+    # Get data, only what changed since the last import if running incrementally
+    # Data is written to chunk files as it is extracted
+    watermarks = load_watermarks(db['name']) if incremental else {}
+    try:
+        d = get_data(pool, db['name'], db['database_root'], salt, email_hashes, watermarks)
+    finally:
+        close_pool(pool)
+    # Chunks kept in memory by a worker process are sent back with the stats
+    d['memory_chunks'] = {key: rows for key, rows in memory_chunks.items() if key[0] == db['name']}
+    return d
+
 def reload_data(dbs):
     # This function triggers loading data from all databases it gets as input.
     # It outputs the data into chunked json files in the 'db' directory.
     # This is done as the APOC calls of Neo4j work best when loading from files in chunks.
-    # Chunk size is 1000 records.
-    # TODO: Set chunk size through parameter when loading script with reload flag.
+    # Chunks are sized by a byte budget per topic. With the Parquet format, large tables are written to one file
+    # per table instead, with a row group per chunk.
+    # Large tables are streamed from the database, so only one chunk of them is held in memory at a time.
 
     print('Loading new data from databases...')
     db_path = './db'
@@ -631,68 +1503,60 @@ def reload_data(dbs):
     else:
         print ("Successfully created the directory %s " % db_path)
 
-    data = {}
-    # Salt for hashing redacted data that is needed for matching, like user emails.    
-    salt = os.urandom(32)
-    for db in dbs:
-
-        db_conn = psycopg2.connect(
-            host=db['host'], 
-            port=db['port'], 
-            dbname=db['dbname'], 
-            user=db['user'], 
-            password=db['password']
-        )
-
-        # Open a cursor to perform database operations
-        db_cursor = db_conn.cursor()
+    # Email hashes are cached between runs and shared by all platforms
+    salt = load_salt(db_path)
+    email_hashes = load_email_hashes(db_path, salt)
+
+    # Databases are independent until they are loaded into Neo4j, so they can be extracted in parallel.
+    # Each worker writes the chunk files of its own database.
+    workers = min(config.get('extraction_workers', 1), len(dbs))
+    if workers > 1:
+        print(f'Extracting {len(dbs)} databases with {workers} worker processes...')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(reload_database, dbs, [salt] * len(dbs), [email_hashes] * len(dbs)))
+    else:
+        results = [reload_database(db, salt, email_hashes) for db in dbs]
 
-        # Get data
-        d = get_data(db_cursor, db['name'], db['database_root'], salt)
-        data[db['name']] = d
+    totals = {}
+    for db, d in zip(dbs, results):
         stats = d['stats']
-        stats['chunk_sizes'] = {}
+        email_hashes.update(d['email_hashes'])
+        memory_chunks.update(d['memory_chunks'])
+        for key in ['users', 'topics', 'posts', 'annotator-annotations']:
+            totals[key] = totals.get(key, 0) + stats[key]
 
         # Site data is always a single object
         with open(f'./db/{db["name"]}_site.json', 'w') as file:
             json.dump(d['site'], file, default=str)
 
-        # Save data in chunks of size n
-        def dumpSplit(data_topic, data_set, stats):
-            path = './db/'
-            n = 1000
-            data_list = list(d[data_topic].values())
-            data_chunks = [data_list[i * n:(i + 1) * n] for i in range((len(data_list) + n - 1) // n )]
-            for num, item in enumerate(data_chunks):
-                with open(f'{path}{data_set}_{data_topic}_{str(num+1)}.json', 'w') as file:
-                    json.dump(item, file, default=str)
-            stats['chunk_sizes'][data_topic] = len(data_chunks)
-            return stats
-
-        stats = dumpSplit('users', db['name'], stats)
-        stats = dumpSplit('groups', db['name'], stats)
-        stats = dumpSplit('tags', db['name'], stats)
-        stats = dumpSplit('categories', db['name'], stats)
-        stats = dumpSplit('topics', db['name'], stats)
-        stats = dumpSplit('posts', db['name'], stats)
-        stats = dumpSplit('replies', db['name'], stats)
-        stats = dumpSplit('quotes', db['name'], stats)
-        stats = dumpSplit('likes', db['name'], stats)
-        stats = dumpSplit('languages', db['name'], stats)
-        stats = dumpSplit('codes', db['name'], stats)
-        stats = dumpSplit('code_names', db['name'], stats)
-        stats = dumpSplit('annotations', db['name'], stats)
+        # Ids of previously imported topics and posts that should no longer be in the graph
+        with open(f'./db/{db["name"]}_removed.json', 'w') as file:
+            json.dump(d['removed'], file, default=str)
+
+        # Watermarks are committed when the graph has been built from this data
+        with open(f'./db/{db["name"]}_watermarks_pending.json', 'w') as file:
+            json.dump(d['watermarks'], file, default=str)
+
+        # Row counts, sizes and checksums of the data files, to verify them before loading
+        with open(f'./db/{db["name"]}_manifest.json', 'w') as file:
+            json.dump(d['manifest'], file)
+        remove_stale_chunks(db['name'], d['manifest'])
 
         # Add chunk sizes to stats last
         with open(f'./db/{db["name"]}_stats.json', 'w') as file:
             json.dump(stats, file, default=str)
 
+    save_email_hashes(db_path, salt, email_hashes)
+
+    print(f'Extracted {totals["users"]} users, {totals["topics"]} topics, {totals["posts"]} posts and {totals["annotator-annotations"]} annotations from {len(dbs)} databases.')
+
 def load_data(dbs):
     # This function is basically just a verification of that the data we need is in files in the db directory. 
-    # TODO: Actually test data integrity before import?
+    # Data files are checked against the manifest written when they were extracted, by streaming their checksums.
+    # Only the record counts are kept, the records themselves are loaded into Neo4j from the files.
 
     print('')
-    print('Loading JSON data files to verify...')
+    print('Verifying data files...')
     print('')
     data = {}
     for db in dbs:
@@ -702,25 +1566,53 @@ def load_data(dbs):
         with open(f'./db/{db["name"]}_stats.json') as file:
             data[db['name']]['stats'] = json.load(file)
             stats = data[db['name']]['stats']
-
-        for topic, chunks in stats['chunk_sizes'].items():
-            data[db['name']][topic] = []
-            for chunk in range(1, chunks + 1):
-                with open(f'./db/{db["name"]}_{topic}_{chunk}.json') as file:
-                    data[db['name']][topic].extend(json.load(file))
+        try:
+            with open(f'./db/{db["name"]}_removed.json') as file:
+                data[db['name']]['removed'] = json.load(file)
+        except FileNotFoundError:
+            data[db['name']]['removed'] = {'visible': None, 'group_members': [], 'tag_topics': []}
+
+        chunk_format = stats.get('chunk_format', 'json')
+        if chunk_format == 'parquet' and pa is None:
+            print(f'Data files of {db["name"]} are in Parquet format, which needs pyarrow.')
+            exit(1)
+
+        manifest = load_manifest(db['name'])
+        data[db['name']]['manifest'] = manifest
+        data[db['name']]['loaded'] = load_manifest(db['name'], 'loaded') or {}
+
+        if manifest is None:
+            # Data extracted before manifests were written can only be counted
+            print(f'No manifest for {db["name"]}, counting records in data files.')
+            data[db['name']]['counts'] = {}
+            for topic, chunks in stats['chunk_sizes'].items():
+                data[db['name']]['counts'][topic] = count_rows(db['name'], topic, chunks, chunk_format)
+        else:
+            counts, problems = verify_manifest(db['name'], manifest)
+            if problems:
+                print(f'Data files of {db["name"]} do not match the manifest:')
+                for problem in problems:
+                    print(f'    {problem}')
+                exit(1)
+            data[db['name']]['counts'] = counts
 
     for k,d in data.items():
         print(f'-------| {k} |-------')
-        print(f'{len(d["users"])} users')
-        print(f'{len(d["groups"])} groups')
-        print(f'{len(d["tags"])} tags.')
-        print(f'{len(d["categories"])} tags.')
-        print(f'{len(d["topics"])} topics and {d["stats"]["pm_threads"]} PM threads.')
+        if d['stats'].get('incremental'):
+            print('Incremental import, counts are for changed records only.')
+            visible = d['removed'].get('visible')
+            if visible:
+                print(f'{len(visible["topics"])} topics and {len(visible["posts"])} posts are visible, others are removed.')
+        print(f'{d["counts"]["users"]} users')
+        print(f'{d["counts"]["groups"]} groups')
+        print(f'{d["counts"]["tags"]} tags.')
+        print(f'{d["counts"]["categories"]} tags.')
+        print(f'{d["counts"]["topics"]} topics and {d["stats"]["pm_threads"]} PM threads.')
         print(f'{d["stats"]["tags_applied"]} tag applications to topics.')
-        print(f'{len(d["posts"])} posts and {d["stats"]["messages"]} private messages.')
-        print(f'{len(d["replies"])} posts are replies to other posts.')
-        print(f'{len(d["quotes"])} quotes.')
-        print(f'{len(d["likes"])} likes.')
+        print(f'{d["counts"]["posts"]} posts and {d["stats"]["messages"]} private messages.')
+        print(f'{d["counts"]["replies"]} posts are replies to other posts.')
+        print(f'{d["counts"]["quotes"]} quotes.')
+        print(f'{d["counts"]["likes"]} likes.')
         
         if d['stats']['omit_pm']:
             print('Private messages have been omitted.')
@@ -734,133 +1626,515 @@ def load_data(dbs):
             print('System users and their content has been omitted.')
 
         print(f'Annotation languages:{d["stats"]["annotator_languages"]}.') 
-        print(f'{len(d["codes"])} ethnographic codes with {len(d["code_names"])} names.')
-        print(f'{len(d["annotations"])} ethnographic annotations.')
+        print(f'{d["counts"]["codes"]} ethnographic codes with {d["counts"]["code_names"]} names.')
+        print(f'{d["counts"]["annotations"]} ethnographic annotations.')
         print(' ')
 
     return data
 
-# Load data from Discourse psql databases and dump to json files
-# Data is loaded from JSON files because Neo4j APOC functions are optimized for this.
-dbs = databases[:]
-if config['reload_from_database']:
-    reload_data(dbs)
-data = load_data(dbs)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
+# Batch sizes and transactions in flight are tuned while loading, see LoadController
+loader_batch_size = config.get('loader_batch_size', 1000)
+loader_max_batch_size = config.get('loader_max_batch_size', 50000)
+loader_max_in_flight = config.get('loader_max_in_flight', 4)
+loader_target_latency = config.get('loader_target_latency', 2.0)
+# Batches that still fail with a transient error after the retries of the driver are tried again,
+# on a new session, after a delay that doubles with each attempt
+loader_retries = config.get('loader_retries', 3)
+loader_retry_delay = config.get('loader_retry_delay', 1.0)
+
+class LoadController:
+    # Tunes the number of records per transaction, and the number of transactions in flight,
+    # with additive increase and multiplicative decrease (AIMD).
+    # Commits within the target latency grow the batch size by a step, and the number of transactions
+    # in flight by one for each round of successful commits. Slow commits halve the batch size.
+    # Transient errors, which the driver retries, halve both.
+    # Batches never span chunks, so the byte budget of the chunks also caps the batch size.
+    # Chunks that APOC reads start at the maximum batch size, so each file is read once, as one batch,
+    # until slow or failed commits shrink the batches below the size of the chunks.
+
+    def __init__(self, max_in_flight=loader_max_in_flight, batch_size=loader_batch_size):
+        self.lock = threading.Lock()
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.in_flight = 1
+        self.step = max(1, loader_batch_size // 4)
+        self.successes = 0
+
+    def record(self, latency, retries):
+        with self.lock:
+            if retries:
+                self.batch_size = max(1, self.batch_size // 2)
+                self.in_flight = max(1, self.in_flight // 2)
+                self.successes = 0
+            elif latency > loader_target_latency:
+                self.batch_size = max(1, self.batch_size // 2)
+            else:
+                self.batch_size = min(loader_max_batch_size, self.batch_size + self.step)
+                self.successes += 1
+                if self.successes >= self.in_flight:
+                    self.in_flight = min(self.max_in_flight, self.in_flight + 1)
+                    self.successes = 0
+
+def chunk_rows(platform, topic, chunk):
+    # Number of records in a JSON chunk, if the manifest has it
+    manifest = platform.get('manifest')
+    if not manifest or topic not in manifest or manifest[topic]['format'] != 'json':
+        return None
+    for entry in manifest[topic]['chunks']:
+        if entry['key'] == chunk:
+            return entry['rows']
+    return None
+
+def chunk_batches(platform, topic, chunk, controller):
+    # Split a chunk into batches of the current batch size of the controller.
+    # Yields the Cypher clause and parameters of each batch, and a description of the rows in it.
+    # The batch size is read for every batch, so batches follow the controller as it adapts.
+    source, params = read_chunk(platform, topic, chunk)
+    if 'rows' not in params:
+        count = chunk_rows(platform, topic, chunk)
+        if count is None or count <= controller.batch_size:
+            yield source, params, ''
+            return
+        # APOC would parse the whole file again for every batch, so the rows of a chunk larger
+        # than the batch size are read here and sent in batches as parameters
+        source, params = 'UNWIND $rows AS value', {'rows': chunk_records(platform, topic, chunk)}
+    rows = params['rows']
+    count = len(rows)
+    start = 0
+    while start < count:
+        end = min(count, start + controller.batch_size)
+        yield source, {'rows': rows[start:end]}, '' if start == 0 and end == count else f', rows {start + 1}-{end}'
+        start = end
+
+# Chunks that failed to load, as (dataset, topic, key), so they are not recorded as loaded
+failed_chunks = set()
+
+def chunk_contents(platform, topic):
+    # Content hash of each chunk of a topic, by key
+    manifest = platform.get('manifest')
+    if not manifest:
+        return {}
+    return {chunk['key']: chunk['content'] for chunk in manifest[topic]['chunks']}
+
+# Loader statements are explained before a stage loads data, to check that they find the nodes they match
+# and merge through indexes. Plans that scan nodes are reported, and fail the stage if plan_audit is 'fail'.
+plan_audit = config.get('plan_audit', 'warn')
+scan_operators = ('AllNodesScan', 'NodeByLabelScan')
+# Only audit the statements, without loading anything
+audit_only = False
+
+class StatementRecorder:
+    # Stands in for a transaction, to get the statements of a transaction function without running them
+
+    def __init__(self):
+        self.statements = []
+
+    def run(self, query, parameters=None, **kwargs):
+        self.statements.append((query, dict(parameters or {}, **kwargs)))
+
+def plan_scans(plan):
+    # Operators of a plan and its children that scan nodes, instead of seeking them in an index
+    operator = plan['operatorType'].split('@')[0]
+    scans = []
+    if operator in scan_operators:
+        details = plan.get('args', {}).get('Details')
+        scans.append(f'{operator} {details}' if details else operator)
+    for child in plan.get('children', []):
+        scans += plan_scans(child)
+    return scans
+
+def audit_statement(tx_function, topic, dataset):
+    # Explain the statements of a loader transaction function, as they are run for a batch of rows
+
+    def tx_explain(tx, query, params):
+        return tx.run(f'EXPLAIN {query}', params).consume().plan
+
+    recorder = StatementRecorder()
+    tx_function(recorder, 'UNWIND $rows AS value', {'rows': []}, dataset)
+    problems = []
+    with driver.session(database=graph_database) as session:
+        for query, params in recorder.statements:
+            plan = session.write_transaction(tx_explain, query, params)
+            problems += plan_scans(plan)
+    if not problems:
+        print(f'Plan of the {topic} loader uses indexes')
+        return
+    print(f'Plan of the {topic} loader scans nodes where an index seek is expected:')
+    for problem in problems:
+        print(f'    {problem}')
+    if plan_audit == 'fail':
+        raise RuntimeError(f'Plan of the {topic} loader scans nodes')
+
+class SessionPool:
+    # One session per loader thread, kept for all the batches of a stage
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = driver.session(database=graph_database)
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def discard(self):
+        # Drop the session of this thread after a connection error, the next batch opens a new one
+        session = getattr(self.local, 'session', None)
+        self.local.session = None
+        if session is not None:
+            with self.lock:
+                self.sessions.remove(session)
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+
+def load_chunks(data, topic, tx_function, label, parallel=True):
+    # Load every chunk of a topic into the graph, platform by platform.
+    # Chunks are split into batches, and batches run in concurrent transactions on a pool of sessions,
+    # as the controller allows. Stages whose batches can merge the same nodes or relationships are not
+    # parallel, as concurrent merges could create duplicates, so they run one transaction at a time.
+    # Incremental imports skip chunks with the same content as the last loaded chunk of the same key.
+
+    if plan_audit != 'off' and data:
+        audit_statement(tx_function, topic, next(iter(data.values()))['site']['name'])
+    if audit_only:
+        return
+
+    for platform in data.values():
+        platform_name = platform['site']['name']
+        chunks = chunk_keys(platform, topic)
+        if platform['stats'].get('incremental'):
+            loaded = platform['loaded'].get(topic, {})
+            contents = chunk_contents(platform, topic)
+            unchanged = [chunk for chunk in chunks if contents.get(chunk) and loaded.get(chunk) == contents[chunk]]
+            if unchanged:
+                print(f'Skipping {len(unchanged)} unchanged {label} chunks from {platform_name}')
+                chunks = [chunk for chunk in chunks if chunk not in unchanged]
+        max_in_flight = loader_max_in_flight if parallel else 1
+        controller = LoadController(max_in_flight, loader_max_batch_size if apoc_loaded(platform, topic) else loader_batch_size)
+        sessions = SessionPool()
+
+        def load_batch(source, params, chunk, rows):
+            # The driver calls the transaction function again when it retries a transient error
+            attempts = []
+
+            def tx_batch(tx):
+                attempts.append(tx)
+                tx_function(tx, source, params, platform_name)
+
+            for retry in range(loader_retries + 1):
+                start = time.time()
+                try:
+                    sessions.session().write_transaction(tx_batch)
+                    controller.record(time.time() - start, len(attempts) - 1)
+                    print(f'Loaded {label} data from {platform_name}, chunk #{chunk}{rows}')
+                    return
+                except (ServiceUnavailable, SessionExpired, TransientError) as e:
+                    sessions.discard()
+                    controller.record(time.time() - start, len(attempts))
+                    if retry == loader_retries:
+                        error = e
+                    else:
+                        print(f'Retrying {topic} on {platform_name}, chunk #{chunk}{rows}: {e}')
+                        time.sleep(loader_retry_delay * 2 ** retry)
+                except Exception as e:
+                    error = e
+                    break
+            failed_chunks.add((platform_name, topic, chunk))
+            print(f'Import failed for {topic} on {platform_name}, chunk #{chunk}{rows}')
+            print(error)
+
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for chunk in chunks:
+                try:
+                    for source, params, rows in chunk_batches(platform, topic, chunk, controller):
+                        while len(pending) >= controller.in_flight:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        pending.add(executor.submit(load_batch, source, params, chunk, rows))
+                except Exception as e:
+                    failed_chunks.add((platform_name, topic, chunk))
+                    print(f'Import failed for {topic} on {platform_name}, chunk #{chunk}')
+                    print(e)
+            wait(pending)
+        sessions.close()
+
+    # Every chunk is tried, but the stage fails if any of them did, so the stages that depend on it do not run
+    failed = sorted(f'{dataset} #{chunk}' for dataset, failed_topic, chunk in failed_chunks if failed_topic == topic)
+    if failed:
+        raise RuntimeError(f'{len(failed)} {topic} chunks failed to load: {", ".join(failed)}')
+
+# Indexes and constraints of the graph, created before any data is loaded.
+# Every node the loader statements match or merge is looked up by one of them, see audit_statement.
+# Records are keyed by their id and platform. Uniqueness constraints on these would need node keys,
+# which only Neo4j Enterprise has, so they are indexes. Platforms and global users have a key of their own,
+# and a uniqueness constraint, which also keeps concurrent merges of the same global user from duplicating it.
+# Constraints replace the indexes that earlier versions of this script created on the same property.
+graph_indexes = [
+    ('index', 'group', 'group', ['discourse_id', 'platform']),
+    ('index', 'user', 'user', ['discourse_id', 'platform']),
+    ('index', 'tag', 'tag', ['discourse_id', 'platform']),
+    ('index', 'categories', 'category', ['discourse_id', 'platform']),
+    ('index', 'topic', 'topic', ['discourse_id', 'platform']),
+    ('index', 'post', 'post', ['discourse_id', 'platform']),
+    ('index', 'languages', 'language', ['discourse_id', 'platform']),
+    ('index', 'codes', 'code', ['discourse_id', 'platform']),
+    ('index', 'code_roots', 'code', ['root_id', 'platform']),
+    ('index', 'codenames', 'codename', ['discourse_id', 'platform']),
+    ('index', 'annotations', 'annotation', ['discourse_id', 'platform']),
+    ('unique', 'platform_name', 'platform', ['name']),
+    ('unique', 'globaluser_email', 'globaluser', ['email'])
+]
+replaced_indexes = ['platform', 'global']
+index_timeout = config.get('index_timeout', 300)
+
+def graph_create_indexes():
+    # Create all indexes and constraints of the graph, and wait until they are online
+
+    def tx_drop_index(tx, name):
+        tx.run(f'DROP INDEX {name} IF EXISTS')
+
+    def tx_create_index(tx, kind, name, label, properties):
+        keys = ", ".join(f"n.{property}" for property in properties)
+        if kind == 'unique':
+            tx.run(
+                f'CREATE CONSTRAINT {name} IF NOT EXISTS '
+                f'FOR (n:{label}) '
+                f'REQUIRE {keys} IS UNIQUE '
+            )
+        else:
+            tx.run(
+                f'CREATE INDEX {name} IF NOT EXISTS '
+                f'FOR (n:{label}) '
+                f'ON ({keys}) '
+            )
+
+    def tx_await_indexes(tx):
+        tx.run('CALL db.awaitIndexes($timeout)', timeout=index_timeout)
+
+    with driver.session(database=graph_database) as session:
+        for name in replaced_indexes:
+            session.write_transaction(tx_drop_index, name)
+        for kind, name, label, properties in graph_indexes:
+            session.write_transaction(tx_create_index, kind, name, label, properties)
+        session.read_transaction(tx_await_indexes)
+    print('Created indexes')
+
+# Database the graph is built in, the default database of the Neo4j user if none.
+# Blue/green builds set it to the database of the new generation.
+graph_database = config.get('neo4j_database', None)
+
+# A full build starts from an empty graph. Data is deleted in batches of relationships and then nodes,
+# so that no transaction has to hold the whole graph. Where the edition of Neo4j allows it, the database
+# can be recreated instead, which is much faster on a large graph.
+clear_batch_size = config.get('clear_batch_size', 10000)
+clear_recreate_database = config.get('clear_recreate_database', False)
+
+def graph_clear():
+    # Clear database function
+
+    def tx_database_name(tx):
+        return tx.run('CALL db.info() YIELD name RETURN name').single()['name']
+
+    def tx_recreate_database(tx, name):
+        tx.run(f'CREATE OR REPLACE DATABASE `{name}` WAIT')
+
+    def tx_schema(tx, kind):
+        return [record['name'] for record in tx.run(f'SHOW {kind} YIELD name, type RETURN name, type') if record['type'] != 'LOOKUP']
+
+    def tx_drop(tx, kind, name):
+        tx.run(f'DROP {kind} `{name}` IF EXISTS')
+
+    def tx_count(tx, pattern, variable):
+        return tx.run(f'MATCH {pattern} RETURN count({variable}) AS count').single()['count']
 
-# Build Neo4j database
+    def tx_delete_batch(tx, pattern, variable, delete):
+        return tx.run(
+            f'MATCH {pattern} '
+            f'WITH {variable} LIMIT $limit '
+            f'{delete} {variable} '
+            f'RETURN count(*) AS deleted ',
+            limit=clear_batch_size
+        ).single()['deleted']
 
-# TODO: Refactor 'for platform in data.values()' loop into function
-# TODO: Refactor create index into function
+    if clear_recreate_database:
+        with driver.session(database=graph_database) as session:
+            name = session.read_transaction(tx_database_name)
+        try:
+            with driver.session(database='system') as session:
+                session.write_transaction(tx_recreate_database, name)
+            print(f'Recreated database {name}')
+            return
+        except Exception as e:
+            print(f'Recreating database {name} failed, clearing it instead.')
+            print(e)
 
-print(' ')
-print('Building Neo4j database...')
-print(' ')
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-uri = config['neo4j_uri']
-driver = GraphDatabase.driver(uri, auth=(config['neo4j_user'], config['neo4j_password']))
-data_path = os.path.abspath('./db/')
+    with driver.session(database=graph_database) as session:
+        # Constraints own their indexes, so they are dropped first
+        for kind, kinds in [('CONSTRAINT', 'CONSTRAINTS'), ('INDEX', 'INDEXES')]:
+            for name in session.read_transaction(tx_schema, kinds):
+                session.write_transaction(tx_drop, kind, name)
+                print(f'Dropped {kind.lower()} {name}')
+
+        # Relationships are deleted before nodes, so that nodes with many relationships are not deleted in one go
+        for label, pattern, variable, delete in [
+            ('relationships', '()-[r]->()', 'r', 'DELETE'),
+            ('nodes', '(n)', 'n', 'DETACH DELETE')
+        ]:
+            total = session.read_transaction(tx_count, pattern, variable)
+            deleted = 0
+            while True:
+                count = session.write_transaction(tx_delete_batch, pattern, variable, delete)
+                if not count:
+                    break
+                deleted += count
+                print(f'Deleted {deleted} of {total} {label}')
+    print('Cleared database')
+
+def graph_remove_content(data):
+    # Remove groups, categories, topics, posts and their annotations that have been omitted or deleted since
+    # they were imported, and group memberships and topic tags that no longer exist.
+    # Only used in incremental mode, a full rebuild starts from an empty graph
+
+    def tx_graph_ids(tx, label, dataset):
+        result = tx.run(f'MATCH (n:{label} {{platform: "{dataset}"}}) RETURN n.discourse_id AS id')
+        return [record['id'] for record in result]
+
+    def tx_remove_memberships(tx, rows, dataset):
+        tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (g:group {{discourse_id: row.id, platform: "{dataset}"}})<-[old:IN_GROUP]-(u:user) '
+            f'WHERE NOT u.discourse_id IN row.users '
+            f'SET u.groups = [id IN u.groups WHERE id <> row.id] '
+            f'DELETE old',
+            rows=rows
+        )
 
-def graph_clear():
-    # Clear database function
+    def tx_removed_tags(tx, rows, dataset):
+        result = tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (:tag {{discourse_id: row.id, platform: "{dataset}"}})<-[:TAGGED_WITH]-(t:topic) '
+            f'WHERE NOT t.discourse_id IN row.topics '
+            f'RETURN row.id AS tag, t.discourse_id AS topic',
+            rows=rows
+        )
+        return [[record['tag'], record['topic']] for record in result]
 
-    def tx_clear_neo4j(tx):
+    def tx_remove_tags(tx, rows, dataset):
         tx.run(
-            f'MATCH (a) DETACH DELETE a '
-            )
+            f'UNWIND $rows AS row '
+            f'MATCH (:tag {{discourse_id: row[0], platform: "{dataset}"}})<-[old:TAGGED_WITH]-(t:topic {{discourse_id: row[1], platform: "{dataset}"}}) '
+            f'SET t.tags = [id IN t.tags WHERE id <> row[0]] '
+            f'DELETE old',
+            rows=rows
+        )
 
-    def tx_clear_fullTextIndexes(tx):
+    def tx_remove_nodes(tx, label, ids, dataset):
+        # Annotations carry the text they quote from their post, so they go with it
+        annotations = 'OPTIONAL MATCH (n)<-[:ANNOTATES]-(a:annotation) DETACH DELETE a, n' if label == 'post' else 'DETACH DELETE n'
         tx.run(
-            f'CALL db.index.fulltext.drop("cooccurrenceRelationshipIndex") '
+            f'UNWIND $ids AS id '
+            f'MATCH (n:{label} {{discourse_id: id, platform: "{dataset}"}}) '
+            f'{annotations}',
+            ids=ids
+        )
+
+    for platform in data.values():
+        with driver.session(database=graph_database) as session:
+            platform_name = platform['site']['name']
+            removed = platform['removed']
+            # Nodes of the graph that are not visible now, by label
+            removed_ids = {}
+            visible = removed.get('visible')
+            for topic, label in [('groups', 'group'), ('categories', 'category'), ('topics', 'topic'), ('posts', 'post')]:
+                if not visible:
+                    removed_ids[topic] = []
+                    continue
+                visible_ids = IdSet(visible[topic])
+                removed_ids[topic] = [id for id in session.read_transaction(tx_graph_ids, label, platform_name) if id not in visible_ids]
+
+            for batch in batches(removed.get('group_members', [])):
+                session.write_transaction(tx_remove_memberships, batch, platform_name)
+            removed_tags = []
+            for batch in batches(removed.get('tag_topics', [])):
+                removed_tags += session.read_transaction(tx_removed_tags, batch, platform_name)
+
+            # Derived relationships through the posts and topics that change are refreshed after the import,
+            # for the keys they have now as well as those they have after it
+            changed_posts = [record['id'] for record in topic_records(platform, 'posts')]
+            changed_topics = [record['id'] for record in topic_records(platform, 'topics')]
+            collect_previous_links(
+                session, platform, removed_ids['posts'] + changed_posts,
+                changed_topics + [topic for tag, topic in removed_tags], removed_ids['posts']
             )
 
-    with driver.session() as session:
-        try:
-            session.write_transaction(tx_clear_neo4j)
-            session.write_transaction(tx_clear_fullTextIndexes)
-            print('Cleared database')
-        except Exception as e:
-            print(e)
+            for batch in batches(removed_tags):
+                session.write_transaction(tx_remove_tags, batch, platform_name)
+            if removed_tags:
+                print(f'Removed {len(removed_tags)} topic tags from {platform_name}')
+            # Removing a group or category also removes its memberships, access and topic links
+            for topic, label in [('groups', 'group'), ('categories', 'category'), ('topics', 'topic'), ('posts', 'post')]:
+                ids = removed_ids[topic]
+                for batch in batches(ids):
+                    session.write_transaction(tx_remove_nodes, label, batch, platform_name)
+                if ids:
+                    print(f'Removed {len(ids)} {topic} from {platform_name}')
 
 def graph_create_platform(data):
     # Add platforms function
+    # Site data is sent as parameters, so platforms are created with any loader transport
 
-    def tx_create_platform(tx, dataset):
-        tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_site.json")'
-            f'YIELD value '
-            f'CREATE (p:platform {{url: value.url, name: "{dataset}"}})'
-        )
-
-    def tx_create_platform_index(tx):
+    def tx_create_platform(tx, site):
         tx.run(
-            f'CREATE INDEX platform IF NOT EXISTS '
-            f'FOR (p:platform) '
-            f'ON (p.name) '
+            'MERGE (p:platform {name: $name}) '
+            'SET p.url = $url',
+            name=site['name'],
+            url=site['url']
         )
 
-    with driver.session() as session:
-        session.write_transaction(tx_create_platform_index)
-
     for platform in data.values():
-        with driver.session() as session:
-            try:
-                session.write_transaction(tx_create_platform, platform['site']['name'])
-                print(f'Loaded platform data from {platform["site"]["name"]}')
-            except Exception as e:
-                print(f'Import failed for platform data on {platform["site"]["name"]}')
-                print(e)
+        with driver.session(database=graph_database) as session:
+            session.write_transaction(tx_create_platform, platform['site'])
+            print(f'Loaded platform data from {platform["site"]["name"]}')
 
     print('Loaded all platforms.')
 
 def graph_create_groups(data):
     # Add user groups function
 
-    def tx_create_groups(tx, chunk, dataset):
+    def tx_create_groups(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_groups_{chunk}.json") '
-            f'YIELD value '
+            f'{source} '
             f'MERGE (g:group {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET g.name = value.name '
             f'WITH g, value '
             f'MATCH (p:platform {{name: "{dataset}"}}) '
             f'WITH g, p '
-            f'MERGE (p)<-[:ON_PLATFORM]-(g) '
-        )
-
-    def tx_create_group_index(tx):
-        tx.run(
-            f'CREATE INDEX group IF NOT EXISTS '
-            f'FOR (g:group) '
-            f'ON (g.discourse_id, g.platform) '
+            f'MERGE (p)<-[:ON_PLATFORM]-(g) ',
+            params
         )
 
-    with driver.session() as session:
-        session.write_transaction(tx_create_group_index)
-        print('Created group index')
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'groups'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_groups, str(chunk), platform_name)
-                    print(f'Loaded group data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for groups on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'groups', tx_create_groups, 'group')
 
     print('Added all groups')
 
 def graph_create_users(data):
     # Add users function
+    # Users imported again by an incremental import are linked to their current groups only
 
-    def tx_create_users(tx, chunk, dataset):
+    def tx_create_users(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_users_{chunk}.json") '
-            f'YIELD value '
+            f'{source} '
             f'MERGE (u:user {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET u.username = value.username '
             f'SET u.email = value.email '
@@ -868,6 +2142,9 @@ def graph_create_users(data):
             f'SET u.consent_updated = value.consent_updated '
             f'SET u.groups = value.groups '
             f'WITH u, value '
+            f'OPTIONAL MATCH (u)-[old:IN_GROUP]->(:group) '
+            f'DELETE old '
+            f'WITH DISTINCT u, value '
             f'MATCH (p:platform {{name: "{dataset}"}}) '
             f'WITH u, p, value '
             f'MERGE (p)<-[:ON_PLATFORM]-(u) '
@@ -875,7 +2152,7 @@ def graph_create_users(data):
             f'UNWIND value.groups AS gids '
             f'MATCH (g:group {{discourse_id: gids, platform: "{dataset}"}}) '
             f'WITH u, g, value '
-            f'CREATE (u)-[:IN_GROUP]->(g) '
+            f'MERGE (u)-[:IN_GROUP]->(g) '
             f'MERGE (global:globaluser {{email: value.email}}) '
             f'SET global.username = value.username '
             f'WITH global, u '
@@ -883,54 +2160,21 @@ def graph_create_users(data):
             f'WITH global '
             f'MATCH (p:platform {{name:"{dataset}" }}) '
             f'WITH p, global '
-            f'MERGE (p)<-[:HAS_ACCOUNT_ON]-(global)'
+            f'MERGE (p)<-[:HAS_ACCOUNT_ON]-(global)',
+            params
         )
 
-    def tx_create_user_index(tx):
-        tx.run(
-            f'CREATE INDEX user IF NOT EXISTS '
-            f'FOR (u:user) '
-            f'ON (u.discourse_id, u.platform) '
-        )
-
-    def tx_create_globaluser_index(tx):
-        tx.run(
-            f'CREATE INDEX global IF NOT EXISTS '
-            f'FOR (g:globaluser) '
-            f'ON (g.email) '
-        )
-
-    with driver.session() as session:
-        session.write_transaction(tx_create_user_index)
-        print('Created user index')
-
-    with driver.session() as session:
-        session.write_transaction(tx_create_globaluser_index)
-        print('Created globaluser index')
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'users'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_users, chunk, platform_name)
-                    print(f'Loaded user data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for users on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'users', tx_create_users, 'user')
 
     print('Added all users')
 
 def graph_create_tags(data):
     # Add tags function
 
-    def tx_create_tags(tx, chunk, dataset):
+    def tx_create_tags(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_tags_{chunk}.json") '
-            f'YIELD value '
-            f'CREATE (tag:tag {{discourse_id: value.id, platform: "{dataset}"}}) '
+            f'{source} '
+            f'MERGE (tag:tag {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET tag.name = value.name '
             f'SET tag.topic_count = value.topic_count '
             f'SET tag.created_at = value.created_at '
@@ -938,42 +2182,20 @@ def graph_create_tags(data):
             f'WITH tag, value '
             f'MATCH (p:platform {{name: "{dataset}"}}) '
             f'WITH tag, p, value '
-            f'CREATE (p)<-[:ON_PLATFORM]-(tag) '
-        )
-
-    def tx_create_tag_index(tx):
-        tx.run(
-            f'CREATE INDEX tag IF NOT EXISTS '
-            f'FOR (t:tag) '
-            f'ON (t.discourse_id, t.platform) '
+            f'MERGE (p)<-[:ON_PLATFORM]-(tag) ',
+            params
         )
 
-    with driver.session() as session:
-        session.write_transaction(tx_create_tag_index)
-        print('Created tag index')
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'tags'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_tags, chunk, platform_name)
-                    print(f'Loaded tag data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for tag on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'tags', tx_create_tags, 'tag')
 
     print('Added all tags')
 
 def graph_create_categories(data):
     # Add categories
 
-    def tx_create_categories(tx, chunk, dataset):
+    def tx_create_categories(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_categories_{chunk}.json") '
-            f'YIELD value '
+            f'{source} '
             f'MERGE (c:category {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET c.name = value.name '
             f'SET c.name_lower = value.name_lower '
@@ -984,7 +2206,7 @@ def graph_create_categories(data):
             f'SET c.permissions = value.permissions '
             f'WITH c, value '
             f'MATCH (p:platform {{name: "{dataset}"}}) '
-            f'CREATE (p)<-[:ON_PLATFORM]-(c) '
+            f'MERGE (p)<-[:ON_PLATFORM]-(c) '
             f'WITH c, value '
             f'UNWIND value.permissions AS permissions '
             f'MATCH (g:group {{discourse_id: permissions, platform: "{dataset}"}}) '
@@ -995,43 +2217,22 @@ def graph_create_categories(data):
             f'"",'
             f'{{c:c, value:value, dataset: c.platform}}) '
             f'YIELD value AS value2 '
-            f'RETURN value2 '
-        )
-
-    def tx_create_category_index(tx):
-        tx.run(
-            f'CREATE INDEX categories IF NOT EXISTS '
-            f'FOR (g:category) '
-            f'ON (g.discourse_id, g.platform) '
+            f'RETURN value2 ',
+            params
         )
 
-    with driver.session() as session:
-        session.write_transaction(tx_create_category_index)
-        print('Created category index')
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'categories'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_categories, chunk, platform_name)
-                    print(f'Loaded category data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for categories on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'categories', tx_create_categories, 'category', parallel=False)
 
     print('Added all categories')
 
 def graph_create_topics(data):
     # Add topics
+    # Topics imported again by an incremental import are linked to their current category, creator and tags only
 
-    def tx_create_topics(tx, chunk, dataset):
+    def tx_create_topics(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_topics_{chunk}.json") '
-            f'YIELD value '
-            f'CREATE (t:topic {{discourse_id: value.id, platform: "{dataset}"}}) '
+            f'{source} '
+            f'MERGE (t:topic {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET t.title = value.title '
             f'SET t.created_at = value.created_at '
             f'SET t.updated_at = value.updated_at '
@@ -1040,58 +2241,68 @@ def graph_create_topics(data):
             f'SET t.tags = value.tags '
             f'SET t.category_id = value.category_id '
             f'WITH t, value '
+            f'OPTIONAL MATCH (t)-[old:IN_CATEGORY|TAGGED_WITH]->() '
+            f'DELETE old '
+            f'WITH DISTINCT t, value '
+            f'OPTIONAL MATCH (t)<-[old:CREATED]-(:user) '
+            f'DELETE old '
+            f'WITH DISTINCT t, value '
             f'MATCH (p:platform {{name: "{dataset}"}}) '
-            f'CREATE (p)<-[:ON_PLATFORM]-(t) '
+            f'MERGE (p)<-[:ON_PLATFORM]-(t) '
             f'WITH t, value '
             f'MATCH (c:category {{discourse_id: value.category_id, platform: "{dataset}"}}) '
-            f'CREATE (c)<-[:IN_CATEGORY]-(t) '
+            f'MERGE (c)<-[:IN_CATEGORY]-(t) '
             f'WITH t, value '
             f'MATCH (u:user {{discourse_id: value.user_id, platform: "{dataset}"}}) '
-            f'CREATE (t)<-[:CREATED]-(u) '
+            f'MERGE (t)<-[:CREATED]-(u) '
             f'WITH t, value '
             f'UNWIND value.tags AS tagids '
             f'MATCH (tag:tag {{discourse_id: tagids, platform: "{dataset}"}}) '
-            f'CREATE (t)-[:TAGGED_WITH]->(tag) '
-        )
-
-    def tx_create_topic_index(tx):
-        tx.run(
-            f'CREATE INDEX topic IF NOT EXISTS '
-            f'FOR (t:topic) '
-            f'ON (t.discourse_id, t.platform) '
+            f'MERGE (t)-[:TAGGED_WITH]->(tag) ',
+            params
         )
 
-    with driver.session() as session:
-        session.write_transaction(tx_create_topic_index)
-        print('Created topic index')
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'topics'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_topics, chunk, platform_name)
-                    print(f'Loaded topic data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for topic on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'topics', tx_create_topics, 'topic')
 
     print('Added all topics')
 
 def graph_create_posts(data):
     # Add posts
-
-    def tx_create_posts(tx, chunk, dataset):
+    # Posts imported again by an incremental import are linked to their current topic and creator only.
+    # Their replies and quotes are linked again from the posts they reply to and quote now, as deleted
+    # replies and quotes leave no trace for the reply and quote stages to find them by.
+
+    def tx_create_posts(tx, source, params, dataset):
+        links = ''
+        if incremental:
+            links = (
+                f'OPTIONAL MATCH (p)-[old:IS_REPLY_TO|CONTAINS_QUOTE_FROM]->(:post) '
+                f'DELETE old '
+                f'WITH DISTINCT p, value '
+                f'CALL {{ '
+                f'WITH p, value '
+                f'UNWIND value.is_reply_to AS id '
+                f'MATCH (replied:post {{discourse_id: id, platform: "{dataset}"}}) '
+                f'MERGE (p)-[:IS_REPLY_TO]->(replied) '
+                f'}} '
+                f'CALL {{ '
+                f'WITH p, value '
+                f'UNWIND value.quotes_posts AS id '
+                f'MATCH (quoted:post {{discourse_id: id, platform: "{dataset}"}}) '
+                f'MERGE (p)-[:CONTAINS_QUOTE_FROM]->(quoted) '
+                f'}} '
+                f'WITH p, value '
+            )
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_posts_{chunk}.json") '
-            f'YIELD value '
-            f'CREATE (p:post {{discourse_id: value.id, platform: "{dataset}"}}) '
+            f'{source} '
+            f'MERGE (p:post {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET p.user_id = value.user_id '
             f'SET p.topic_id = value.topic_id '
             f'SET p.post_number = value.post_number '
-            f'SET p.raw = value.raw '
+            f'SET p.raw_excerpt = value.raw_excerpt '
+            f'SET p.raw_length = value.raw_length '
+            f'SET p.raw_hash = value.raw_hash '
+            f'REMOVE p.raw '
             f'SET p.created_at = value.created_at '
             f'SET p.updated_at = value.updated_at '
             f'SET p.deleted_at = value.deleted_at '
@@ -1104,6 +2315,13 @@ def graph_create_posts(data):
             f'SET p.reply_count = value.reply_count '
             f'SET p.quote_count = value.quote_count '
             f'WITH p, value '
+            f'OPTIONAL MATCH (p)-[old:IN_TOPIC]->(:topic) '
+            f'DELETE old '
+            f'WITH DISTINCT p, value '
+            f'OPTIONAL MATCH (p)<-[old:CREATED]-(:user) '
+            f'DELETE old '
+            f'WITH DISTINCT p, value '
+            f'{links}'
             f'MATCH (platform:platform {{name: "{dataset}"}}) '
             f'MERGE (platform)<-[:ON_PLATFORM]-(p) '
             f'WITH p, value '
@@ -1114,94 +2332,391 @@ def graph_create_posts(data):
             f'SET p.username = u.username '
             f'WITH p, t '
             f'SET p.topic_title = t.title '
-            f'MERGE (t)<-[r:IN_TOPIC]-(p)'
-        )
-
-    def tx_create_post_index(tx):
-        tx.run(
-            f'CREATE INDEX post IF NOT EXISTS '
-            f'FOR (g:post) '
-            f'ON (g.discourse_id, g.platform) '
+            f'MERGE (t)<-[r:IN_TOPIC]-(p)',
+            params
         )
 
-    with driver.session() as session:
-        try:
-            session.write_transaction(tx_create_post_index)
-            print('Created post index')
-        except Exception as e:
-            print(f'Creating post index failed on {platform_name}')
-            print(e)
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'posts'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_posts, chunk, platform_name)
-                    print(f'Loaded post data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for posts on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'posts', tx_create_posts, 'post')
 
     print('Added all posts')
 
 def graph_create_replies(data):
     # Add replies
     
-    def tx_create_replies(tx, chunk, dataset):
+    def tx_create_replies(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_replies_{chunk}.json") '
-            f'YIELD value '
+            f'{source} '
             f'MATCH (p1:post {{discourse_id: value.reply_post_id, platform: "{dataset}"}}) '
             f'MATCH (p2:post {{discourse_id: value.post_id, platform: "{dataset}"}}) '
-            f'CREATE (p2)<-[r:IS_REPLY_TO]-(p1) '
+            f'MERGE (p2)<-[r:IS_REPLY_TO]-(p1) ',
+            params
         )
     
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'replies'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_replies, chunk, platform_name)
-                    print(f'Loaded reply data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for replies on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'replies', tx_create_replies, 'reply', parallel=False)
 
     print('Added all reply links')
 
 def graph_create_quotes(data):
     # Add quotes
     
-    def tx_create_quotes(tx, chunk, dataset):
+    def tx_create_quotes(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_quotes_{chunk}.json") '
-            f'YIELD value '
+            f'{source} '
             f'MATCH (p1:post {{discourse_id: value.quoted_post_id, platform: "{dataset}"}}) '
             f'MATCH (p2:post {{discourse_id: value.post_id, platform: "{dataset}"}}) '
-            f'CREATE (p1)<-[r:CONTAINS_QUOTE_FROM]-(p2) '
+            f'MERGE (p1)<-[r:CONTAINS_QUOTE_FROM]-(p2) ',
+            params
         )
     
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'quotes'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_quotes, chunk, platform_name)
-                    print(f'Loaded quote data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import quote for reply on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'quotes', tx_create_quotes, 'quote', parallel=False)
 
     print('Added all quote links')
 
-def graph_create_interactions():
+# Incremental imports refresh only the derived relationships that the changed records can affect, instead
+# of counting them again over the whole graph. Their keys are collected from the records of the import:
+# pairs of users from replies, quotes, likes and changed posts, and the codes of annotations, with the other
+# codes of their posts in each corpus. Keys through posts and topics that the import changes or removes are
+# also collected before the import, as a post can move to another topic, and a topic to other tags.
+# Each key is then counted again from its own nodes, so a refresh scales with the size of the change
+# rather than with the size of the forum. Relationships whose count drops to nothing are deleted.
+
+def batches(items):
+    # Slices of a list, of the loader batch size
+    for i in range(0, len(items), loader_batch_size):
+        yield items[i:i + loader_batch_size]
+
+def post_user_pairs(session, dataset, post_ids):
+    # Pairs of users who interact through replies, quotes and likes of posts, as (start, end)
+
+    def tx_user_pairs(tx, ids):
+        result = tx.run(
+            f'UNWIND $ids AS id '
+            f'MATCH (p:post {{discourse_id: id, platform: "{dataset}"}})<-[:CREATED]-(u1:user) '
+            f'MATCH (p)-[:IS_REPLY_TO|CONTAINS_QUOTE_FROM]-(:post)<-[:CREATED]-(u2:user) '
+            f'RETURN u1.discourse_id AS start, u2.discourse_id AS end '
+            f'UNION '
+            f'UNWIND $ids AS id '
+            f'MATCH (p:post {{discourse_id: id, platform: "{dataset}"}})<-[:CREATED]-(u2:user) '
+            f'MATCH (p)<-[:LIKES]-(u1:user) '
+            f'RETURN u1.discourse_id AS start, u2.discourse_id AS end',
+            ids=ids
+        )
+        return [(record['start'], record['end']) for record in result]
+
+    pairs = set()
+    for batch in batches(post_ids):
+        pairs.update(session.read_transaction(tx_user_pairs, batch))
+    return pairs
+
+def topic_posts(session, dataset, topic_ids):
+    # Posts of topics
+
+    def tx_topic_posts(tx, ids):
+        result = tx.run(
+            f'UNWIND $ids AS id '
+            f'MATCH (:topic {{discourse_id: id, platform: "{dataset}"}})<-[:IN_TOPIC]-(p:post) '
+            f'RETURN p.discourse_id AS post',
+            ids=ids
+        )
+        return [record['post'] for record in result]
+
+    posts = []
+    for batch in batches(topic_ids):
+        posts += session.read_transaction(tx_topic_posts, batch)
+    return posts
+
+def post_codes(session, dataset, post_ids):
+    # Codes of the annotations on posts in a corpus, as (corpus, post, code)
+
+    def tx_post_codes(tx, ids):
+        result = tx.run(
+            f'UNWIND $ids AS id '
+            f'MATCH (p:post {{discourse_id: id, platform: "{dataset}"}})-[:IN_TOPIC]->(:topic)-[:TAGGED_WITH]->(t:tag) '
+            f'WHERE t.name STARTS WITH "ethno-" '
+            f'MATCH (p)<-[:ANNOTATES]-(:annotation)-[:REFERS_TO]->(code:code) '
+            f'RETURN DISTINCT t.name AS corpus, id AS post, code.discourse_id AS code',
+            ids=ids
+        )
+        return [(record['corpus'], record['post'], record['code']) for record in result]
+
+    codes = []
+    for batch in batches(post_ids):
+        codes += session.read_transaction(tx_post_codes, batch)
+    return codes
+
+def post_code_uses(session, dataset, post_ids):
+    # Creators and codes of the annotations on posts, as (user, code)
+
+    def tx_post_code_uses(tx, ids):
+        result = tx.run(
+            f'UNWIND $ids AS id '
+            f'MATCH (:post {{discourse_id: id, platform: "{dataset}"}})<-[:ANNOTATES]-(a:annotation)-[:REFERS_TO]->(code:code) '
+            f'MATCH (a)<-[:CREATED]-(u:user) '
+            f'RETURN DISTINCT u.discourse_id AS user, code.discourse_id AS code',
+            ids=ids
+        )
+        return [(record['user'], record['code']) for record in result]
+
+    uses = set()
+    for batch in batches(post_ids):
+        uses.update(session.read_transaction(tx_post_code_uses, batch))
+    return uses
+
+def collect_previous_links(session, platform, post_ids, topic_ids, removed_post_ids):
+    # Keys of the derived relationships through posts and topics, as they are before the import changes them.
+    # Annotations of removed posts are removed with them, so the use of their codes is collected too.
+    dataset = platform['site']['name']
+    links = platform.setdefault('previous_links', {'users': set(), 'codes': [], 'uses': set()})
+    links['users'].update(post_user_pairs(session, dataset, post_ids))
+    posts = sorted(set(post_ids) | set(topic_posts(session, dataset, topic_ids)))
+    links['codes'] += post_codes(session, dataset, posts)
+    links['uses'].update(post_code_uses(session, dataset, removed_post_ids))
+
+def interaction_changes(session, platform):
+    # Pairs of users, in either order, whose interactions the import can change
+
+    def tx_post_pairs(tx, rows, dataset):
+        result = tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (:post {{discourse_id: row[0], platform: "{dataset}"}})<-[:CREATED]-(u1:user) '
+            f'MATCH (:post {{discourse_id: row[1], platform: "{dataset}"}})<-[:CREATED]-(u2:user) '
+            f'RETURN u1.discourse_id AS start, u2.discourse_id AS end',
+            rows=rows
+        )
+        return [(record['start'], record['end']) for record in result]
+
+    def tx_like_pairs(tx, rows, dataset):
+        result = tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (u1:user {{discourse_id: row[0], platform: "{dataset}"}}) '
+            f'MATCH (:post {{discourse_id: row[1], platform: "{dataset}"}})<-[:CREATED]-(u2:user) '
+            f'RETURN u1.discourse_id AS start, u2.discourse_id AS end',
+            rows=rows
+        )
+        return [(record['start'], record['end']) for record in result]
+
+    dataset = platform['site']['name']
+    pairs = set(platform.get('previous_links', {}).get('users', ()))
+    for topic, first, second in (('replies', 'reply_post_id', 'post_id'), ('quotes', 'post_id', 'quoted_post_id')):
+        rows = [[record[first], record[second]] for record in topic_records(platform, topic)]
+        for batch in batches(rows):
+            pairs.update(session.read_transaction(tx_post_pairs, batch, dataset))
+    rows = [[record['user_id'], record['post_id']] for record in topic_records(platform, 'likes')]
+    for batch in batches(rows):
+        pairs.update(session.read_transaction(tx_like_pairs, batch, dataset))
+    # A changed post can have another creator
+    pairs.update(post_user_pairs(session, dataset, [record['id'] for record in topic_records(platform, 'posts')]))
+    return set((min(start, end), max(start, end)) for start, end in pairs)
+
+def annotation_changes(session, platform):
+    # Keys of the code relationships that the import can change: pairs of codes in a corpus, from the lower
+    # code id, and codes in a corpus. A new annotation pairs its code with the other codes of its post.
+    # A removed or changed post, or a post in a changed topic, which can have moved in or out of a corpus,
+    # pairs all of its codes, before and after the import.
+
+    def post_code_sets(codes):
+        posts = {}
+        for corpus, post, code in codes:
+            posts.setdefault((corpus, post), set()).add(code)
+        return posts.items()
+
+    dataset = platform['site']['name']
+    annotated = set((record['post_id'], record['tag_id']) for record in topic_records(platform, 'annotations'))
+    topic_ids = [record['id'] for record in topic_records(platform, 'topics')]
+    changed_posts = set(record['id'] for record in topic_records(platform, 'posts'))
+    changed_posts.update(topic_posts(session, dataset, topic_ids))
+
+    pairs = set()
+    corpus_codes = set()
+    codes = post_codes(session, dataset, sorted(set(post for post, code in annotated)))
+    for (corpus, post), post_code_set in post_code_sets(codes):
+        for code in post_code_set:
+            if (post, code) in annotated:
+                corpus_codes.add((corpus, code))
+                pairs.update((corpus, min(code, other), max(code, other)) for other in post_code_set if other != code)
+    codes = platform.get('previous_links', {}).get('codes', []) + post_codes(session, dataset, sorted(changed_posts))
+    for (corpus, post), post_code_set in post_code_sets(codes):
+        corpus_codes.update((corpus, code) for code in post_code_set)
+        pairs.update((corpus, code, other) for code in post_code_set for other in post_code_set if code < other)
+    return pairs, corpus_codes
+
+# Patterns that count each interaction between a start and an end, as the interaction stage matches them
+interaction_patterns = {
+    'TALKED_TO': '{start}-[:CREATED]->(:post)-[r:IS_REPLY_TO]-(:post)<-[:CREATED]-{end}',
+    'QUOTED': '{start}-[:CREATED]->(:post)-[r:CONTAINS_QUOTE_FROM]->(:post)<-[:CREATED]-{end}',
+    'TALKED_OR_QUOTED': '{start}-[:CREATED]->(:post)-[r:IS_REPLY_TO|CONTAINS_QUOTE_FROM]-(:post)<-[:CREATED]-{end}',
+    'LIKES': '{start}-[r:LIKES]->(:post)<-[:CREATED]-{end}'
+}
+
+def graph_refresh_interactions(data):
+    # Count the interactions of the pairs of users that the import changed again, and those of their global users
+
+    def tx_global_pairs(tx, rows, dataset):
+        result = tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (:user {{discourse_id: row[0], platform: "{dataset}"}})-[:IS_GLOBAL_USER]->(g1:globaluser) '
+            f'MATCH (:user {{discourse_id: row[1], platform: "{dataset}"}})-[:IS_GLOBAL_USER]->(g2:globaluser) '
+            f'RETURN g1.email AS start, g2.email AS end',
+            rows=rows
+        )
+        return [(record['start'], record['end']) for record in result]
+
+    def tx_refresh_interactions(tx, type, label, directed, rows, dataset):
+        if label == 'user':
+            start, end = f'{{discourse_id: row.start, platform: "{dataset}"}}', f'{{discourse_id: row.end, platform: "{dataset}"}}'
+            pattern = interaction_patterns[type].format(start='(a)', end='(b)')
+        else:
+            start, end = '{email: row.start}', '{email: row.end}'
+            pattern = interaction_patterns[type].format(start='(a)<-[:IS_GLOBAL_USER]-(:user)', end='(:user)-[:IS_GLOBAL_USER]->(b)')
+        arrow = '->' if directed else '-'
+        tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (a:{label} {start}) '
+            f'MATCH (b:{label} {end}) '
+            f'OPTIONAL MATCH {pattern} '
+            f'WITH a, b, count(r) AS c '
+            f'OPTIONAL MATCH (a)-[old:{type}]{arrow}(b) '
+            f'FOREACH (x IN CASE WHEN c = 0 AND old IS NOT NULL THEN [old] ELSE [] END | DELETE x) '
+            f'FOREACH (x IN CASE WHEN c > 0 THEN [c] ELSE [] END | MERGE (a)-[r2:{type}]{arrow}(b) SET r2.count = x)',
+            rows=rows
+        )
+
+    def refresh(session, label, pairs, dataset=None):
+        for type, topics, directed in interaction_types:
+            rows = [{'start': start, 'end': end} for start, end in pairs]
+            if directed:
+                rows += [{'start': end, 'end': start} for start, end in pairs if start != end]
+            for batch in batches(rows):
+                session.write_transaction(tx_refresh_interactions, type, label, directed, batch, dataset)
+
+    global_pairs = set()
+    with driver.session(database=graph_database) as session:
+        for platform in data.values():
+            dataset = platform['site']['name']
+            pairs = sorted(interaction_changes(session, platform))
+            refresh(session, 'user', pairs, dataset)
+            for batch in batches([list(pair) for pair in pairs]):
+                global_pairs.update(session.read_transaction(tx_global_pairs, batch, dataset))
+            print(f'Refreshed interactions of {len(pairs)} pairs of users on {dataset}')
+        global_pairs = sorted(set((min(start, end), max(start, end)) for start, end in global_pairs))
+        refresh(session, 'globaluser', global_pairs)
+        print(f'Refreshed interactions of {len(global_pairs)} pairs of global users')
+
+# Interactions between users, counted from the relationships of their posts: the relationship type,
+# the topics it counts, and whether it points from the user who replied, quoted or liked.
+interaction_types = (
+    ('TALKED_TO', ('replies',), False),
+    ('QUOTED', ('quotes',), True),
+    ('TALKED_OR_QUOTED', ('replies', 'quotes'), False),
+    ('LIKES', ('likes',), True)
+)
+
+# Full builds count interactions here from the data files, when numpy is installed.
+# Incremental builds count them in the graph, which also holds the content of earlier builds.
+count_interactions_here = np is not None and not incremental
+
+def id_pairs(platform, topic, first, second):
+    # Two id columns of the records of a topic, as an array of distinct pairs.
+    # The loader stages merge relationships, so a pair extracted twice is one relationship.
+    records = topic_records(platform, topic)
+    pairs = np.fromiter(chain.from_iterable((record[first], record[second]) for record in records), dtype=np.int64)
+    return np.unique(pairs.reshape(-1, 2), axis=0)
+
+def lookup_ids(ids, values, query):
+    # Values of the query ids in the sorted array ids, and which of them were found
+    if not len(ids):
+        return np.zeros(len(query), dtype=np.int64), np.zeros(len(query), dtype=bool)
+    index = np.minimum(np.searchsorted(ids, query), len(ids) - 1)
+    return values[index], ids[index] == query
+
+def count_pairs(starts, ends, directed):
+    # Count each pair of nodes, like count(r) over a pattern between them. An undirected pattern matches
+    # a relationship from both ends, so it counts it once for two nodes and twice for a node with itself.
+    # Undirected pairs start from the lower id.
+    if not directed:
+        starts, ends = np.minimum(starts, ends), np.maximum(starts, ends)
+    pairs, counts = np.unique(np.stack([starts, ends], axis=1), axis=0, return_counts=True)
+    if not directed:
+        counts[pairs[:, 0] == pairs[:, 1]] *= 2
+    return pairs, counts
+
+def count_interactions(data):
+    # Count the interactions between users, and between global users, from the data files, as the
+    # patterns of the interaction stage count them in the graph. Only relationships that the loader
+    # stages create are counted, between posts and users that exist, through the CREATED relationships
+    # of the posts. Returns the type, label, direction and rows of each kind of interaction,
+    # with users keyed by platform and id, and global users by email.
+    global_ids = {}
+    global_pairs = {type: [] for type, topics, directed in interaction_types}
+    interactions = []
+
+    for platform in data.values():
+        dataset = platform['site']['name']
+
+        group_ids = set(group['id'] for group in topic_records(platform, 'groups'))
+        user_ids = array('q')
+        user_globals = array('q')
+        for user in topic_records(platform, 'users'):
+            user_ids.append(user['id'])
+            # Users are only linked to a global user through at least one known group
+            if any(gid in group_ids for gid in user['groups']):
+                user_globals.append(global_ids.setdefault(user['email'], len(global_ids)))
+            else:
+                user_globals.append(-1)
+        user_ids = np.array(user_ids, dtype=np.int64)
+        user_globals = np.array(user_globals, dtype=np.int64)
+        order = np.argsort(user_ids)
+        user_ids, user_globals = user_ids[order], user_globals[order]
+
+        # Posts by their creator, left out where the creator does not exist
+        posts = id_pairs(platform, 'posts', 'id', 'user_id')
+        posts = posts[lookup_ids(user_ids, user_ids, posts[:, 1])[1]]
+        post_ids, creators = posts[:, 0], posts[:, 1]
+
+        # Users at both ends of each relationship. A pattern can't match a relationship of a post
+        # with itself, it would have to match the CREATED relationship of the post twice.
+        users = {}
+        for topic, first, second in (('replies', 'reply_post_id', 'post_id'), ('quotes', 'post_id', 'quoted_post_id')):
+            pairs = id_pairs(platform, topic, first, second)
+            pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+            starts, start_found = lookup_ids(post_ids, creators, pairs[:, 0])
+            ends, end_found = lookup_ids(post_ids, creators, pairs[:, 1])
+            users[topic] = (starts[start_found & end_found], ends[start_found & end_found])
+        pairs = id_pairs(platform, 'likes', 'user_id', 'post_id')
+        start_found = lookup_ids(user_ids, user_ids, pairs[:, 0])[1]
+        ends, end_found = lookup_ids(post_ids, creators, pairs[:, 1])
+        users['likes'] = (pairs[start_found & end_found, 0], ends[start_found & end_found])
+
+        for type, topics, directed in interaction_types:
+            starts = np.concatenate([users[topic][0] for topic in topics])
+            ends = np.concatenate([users[topic][1] for topic in topics])
+            pairs, counts = count_pairs(starts, ends, directed)
+            rows = [
+                {'platform': dataset, 'start': start, 'end': end, 'count': count}
+                for (start, end), count in zip(pairs.tolist(), counts.tolist())
+            ]
+            interactions.append((type, 'user', directed, rows))
+            # A user can't be at both ends of an interaction of global users,
+            # the pattern would have to match their IS_GLOBAL_USER relationship twice
+            start_globals = lookup_ids(user_ids, user_globals, starts)[0]
+            end_globals = lookup_ids(user_ids, user_globals, ends)[0]
+            linked = (start_globals >= 0) & (end_globals >= 0) & (starts != ends)
+            global_pairs[type].append((start_globals[linked], end_globals[linked]))
+
+    # Global users are shared by platforms, so their interactions are counted over all of them
+    emails = list(global_ids)
+    for type, topics, directed in interaction_types:
+        starts = np.concatenate([starts for starts, ends in global_pairs[type]])
+        ends = np.concatenate([ends for starts, ends in global_pairs[type]])
+        pairs, counts = count_pairs(starts, ends, directed)
+        rows = [
+            {'start': emails[start], 'end': emails[end], 'count': count}
+            for (start, end), count in zip(pairs.tolist(), counts.tolist())
+        ]
+        interactions.append((type, 'globaluser', directed, rows))
+    return interactions
+
+def graph_create_interactions(data):
     # Add interactions
 
     def tx_create_user_talks(tx):
@@ -1252,121 +2767,108 @@ def graph_create_interactions():
             f'SET ur.count = c '
         )
 
-    with driver.session() as session:
-        try:
-            session.write_transaction(tx_create_user_talks)
-            print('Created user talk graph')
-        except Exception as e:
-            print('Creating user talk graph failed.')
-            print(e)
-        try:
-            session.write_transaction(tx_create_global_user_talks)
-            print('Created global user talk graph')
-        except Exception as e:
-            print('Creating global user talk graph failed.')
-            print(e)
-        try:
-            session.write_transaction(tx_create_user_quotes)
-            print('Created user quote graph')
-        except Exception as e:
-            print('Creating user quote graph failed.')
-            print(e)
-        try:
-            session.write_transaction(tx_create_global_user_quotes)
-            print('Created global user quote graph')
-        except Exception as e:
-            print('Creating global user quote graph failed.')
-            print(e)
-        try:
-            session.write_transaction(tx_create_user_talks_and_quotes)
-            print('Created user talk and quote graph')
-        except Exception as e:
-            print('Creating user talk and quote graph failed.')
-            print(e)
-        try:
-            session.write_transaction(tx_create_global_user_talks_and_quotes)
-            print('Created global user talk and quote graph')
-        except Exception as e:
-            print('Creating global user talk and quote graph failed.')
-            print(e)
+    def tx_create_user_likes(tx):
+        tx.run(
+            f'MATCH (g1:globaluser)<-[:IS_GLOBAL_USER]-()-[r:LIKES]->(:post)<-[:CREATED]-()-[:IS_GLOBAL_USER]->(g2:globaluser) '
+            f'WITH g1, g2, count(r) AS c '
+            f'MERGE (g1)-[gr:LIKES]->(g2) '
+            f'SET gr.count = c '
+        )
+
+    def tx_create_global_user_likes(tx):
+        tx.run(
+            f'MATCH (u1:user)-[r:LIKES]->(:post)<-[:CREATED]-(u2:user) '
+            f'WITH u1, u2, count(r) AS c '
+            f'MERGE (u1)-[ur:LIKES]->(u2) '
+            f'SET ur.count = c '
+        )
+
+    def tx_create_counted_interactions(tx, type, label, directed, rows):
+        if label == 'user':
+            start, end = '{discourse_id: row.start, platform: row.platform}', '{discourse_id: row.end, platform: row.platform}'
+        else:
+            start, end = '{email: row.start}', '{email: row.end}'
+        tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (a:{label} {start}) '
+            f'MATCH (b:{label} {end}) '
+            f'MERGE (a)-[r:{type}]{"->" if directed else "-"}(b) '
+            f'SET r.count = row.count',
+            rows=rows
+        )
+
+    if count_interactions_here:
+        interactions = count_interactions(data)
+        with driver.session(database=graph_database) as session:
+            for type, label, directed, rows in interactions:
+                for i in range(0, len(rows), loader_batch_size):
+                    session.write_transaction(tx_create_counted_interactions, type, label, directed, rows[i:i + loader_batch_size])
+                print(f'Created {label} {type} graph with {len(rows)} links')
+        print('Added all user to user interaction links')
+        return
+
+    if incremental:
+        graph_refresh_interactions(data)
+        print('Added all user to user interaction links')
+        return
+
+    with driver.session(database=graph_database) as session:
+        for tx_function, description in [
+            (tx_create_user_talks, 'user talk'),
+            (tx_create_global_user_talks, 'global user talk'),
+            (tx_create_user_quotes, 'user quote'),
+            (tx_create_global_user_quotes, 'global user quote'),
+            (tx_create_user_talks_and_quotes, 'user talk and quote'),
+            (tx_create_global_user_talks_and_quotes, 'global user talk and quote'),
+            (tx_create_user_likes, 'user like'),
+            (tx_create_global_user_likes, 'global user like')
+        ]:
+            session.write_transaction(tx_function)
+            print(f'Created {description} graph')
 
     print('Added all user to user interaction links')
 
 def graph_create_likes(data):
     # Add likes
 
-    def tx_create_likes(tx, chunk, dataset):
+    def tx_create_likes(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_likes_{chunk}.json") '
-            f'YIELD value '
+            f'{source} '
             f'MATCH (p:post {{discourse_id: value.post_id, platform: "{dataset}"}}) '
             f'MATCH (u:user {{discourse_id: value.user_id, platform: "{dataset}"}}) '
-            f'CREATE (p)<-[r:LIKES]-(u) '
+            f'MERGE (p)<-[r:LIKES]-(u) ',
+            params
         )
 
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'likes'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_likes, chunk, platform_name)
-                    print(f'Loaded likes data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import likes for reply on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'likes', tx_create_likes, 'likes', parallel=False)
 
     print('Added all like links')
 
 def graph_create_languages(data):
     # Add annotation languages
 
-    def tx_create_create_languages(tx, chunk, dataset):
+    def tx_create_create_languages(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_languages_{chunk}.json") '
-            f'YIELD value '
-            f'CREATE (lang:language {{discourse_id: value.id, platform: "{dataset}"}}) '
+            f'{source} '
+            f'MERGE (lang:language {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET lang.name = value.name '
             f'SET lang.locale = value.locale '
             f'WITH lang, value '
             f'MATCH (p:platform {{name: "{dataset}"}}) '
             f'WITH lang, p, value '
-            f'MERGE (p)<-[:ON_PLATFORM]-(lang) '
-        )
-
-    def tx_create_language_index(tx):
-        tx.run(
-            f'CREATE INDEX languages IF NOT EXISTS '
-            f'FOR (lang:language) '
-            f'ON (lang.discourse_id, lang.platform) '
+            f'MERGE (p)<-[:ON_PLATFORM]-(lang) ',
+            params
         )
 
-    with driver.session() as session:
-        session.write_transaction(tx_create_language_index)
-        print('Created language index')
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'languages'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_create_languages, chunk, platform_name)
-                    print(f'Loaded language data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import for language on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'languages', tx_create_create_languages, 'language')
 
 def graph_create_codes(data):
     # Add annotation codes
 
-    def tx_create_codes(tx, chunk, dataset):
+    def tx_create_codes(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_codes_{chunk}.json") '
-            f'YIELD value '
-            f'CREATE (code:code {{discourse_id: value.id, platform: "{dataset}"}}) '
+            f'{source} '
+            f'MERGE (code:code {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET code.name = value.name '
             f'SET code.description = value.description '
             f'SET code.creator_id = value.creator_id '
@@ -1377,65 +2879,69 @@ def graph_create_codes(data):
             f'WITH code, value '
             f'MATCH (p:platform {{name: "{dataset}"}}) '
             f'WITH code, p, value '
-            f'CREATE (p)<-[:ON_PLATFORM]-(code) '
+            f'MERGE (p)<-[:ON_PLATFORM]-(code) '
             f'WITH code, value '
             f'MATCH (u:user {{discourse_id: value.creator_id, platform: "{dataset}"}}) '
-            f'CREATE (u)-[:CREATED]->(code)'
+            f'MERGE (u)-[:CREATED]->(code)',
+            params
         )
 
-    def tx_create_code_index(tx):
-        tx.run(
-            f'CREATE INDEX codes IF NOT EXISTS '
-            f'FOR (code:code) '
-            f'ON (code.discourse_id, code.platform) '
-        )
+    load_chunks(data, 'codes', tx_create_codes, 'code')
 
-    with driver.session() as session:
-        session.write_transaction(tx_create_code_index)
-        print('Created code index')
-
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'codes'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_codes, chunk, platform_name)
-                    print(f'Loaded code data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import for codes on {platform_name}, chunk #{chunk}')
-                    print(e)
+def code_ancestors(code):
+    # Ancestors of a code from its materialized ancestry path, the ids from its root down to its parent,
+    # as (id, depth) with the parent at depth 1. A code without ancestry is a root.
+    path = [int(id) for id in (code.get('ancestry') or '').split('/') if id]
+    return [(id, len(path) - i) for i, id in enumerate(path)]
 
 def graph_create_code_ancestry(data):
     # Create ancestry relations
+    # Codes link to their parent, and to every ancestor with its depth, so that the codes of a subtree
+    # are one hop from its top code. Codes also get the id of their root and their depth.
+    # Ancestors that were not extracted are merged without properties. Links of a code that moved
+    # in an incremental import are replaced.
 
-    def tx_create_code_ancestry(tx, dataset):
+    def tx_create_code_ancestry(tx, rows, dataset):
         tx.run(
-            f'MATCH (c:code) WHERE c.ancestry CONTAINS "/" '
-            f'WITH toInteger(split(c.ancestry,"/")[-1]) AS cid, c AS child '
-            f'MERGE (parent:code {{discourse_id: cid, platform: child.platform}}) '
-            f'MERGE (parent)<-[:HAS_PARENT_CODE]-(child) '
+            f'UNWIND $rows AS row '
+            f'MATCH (code:code {{discourse_id: row.id, platform: "{dataset}"}}) '
+            f'SET code.root_id = row.root_id '
+            f'SET code.depth = row.depth '
+            f'WITH code, row '
+            f'OPTIONAL MATCH (code)-[old:HAS_PARENT_CODE|HAS_ANCESTOR]->(:code) '
+            f'DELETE old '
+            f'WITH DISTINCT code, row '
+            f'UNWIND row.ancestors AS ancestor '
+            f'MERGE (a:code {{discourse_id: ancestor.id, platform: "{dataset}"}}) '
+            f'MERGE (code)-[r:HAS_ANCESTOR]->(a) '
+            f'SET r.depth = ancestor.depth '
+            f'FOREACH (x IN CASE WHEN ancestor.depth = 1 THEN [a] ELSE [] END | MERGE (code)-[:HAS_PARENT_CODE]->(x))',
+            rows=rows
         )
 
     for platform in data.values():
-        with driver.session() as session:
+        with driver.session(database=graph_database) as session:
             platform_name = platform['site']['name']
-            try:
-                session.write_transaction(tx_create_code_ancestry, platform_name)
-                print(f'Loaded code ancestry from {platform_name}')
-            except Exception as e:
-                print(f'Import failed for code ancestry on {platform_name}')
-                print(e)
+            rows = []
+            for code in topic_records(platform, 'codes'):
+                ancestors = code_ancestors(code)
+                rows.append({
+                    'id': code['id'],
+                    'root_id': ancestors[0][0] if ancestors else code['id'],
+                    'depth': len(ancestors),
+                    'ancestors': [{'id': id, 'depth': depth} for id, depth in ancestors]
+                })
+            for batch in batches(rows):
+                session.write_transaction(tx_create_code_ancestry, batch, platform_name)
+            print(f'Loaded code ancestry from {platform_name}')
 
 def graph_create_code_names(data):
     # Add annotation code names
 
-    def tx_create_code_names(tx, chunk, dataset):
+    def tx_create_code_names(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_code_names_{chunk}.json") '
-            f'YIELD value '
-            f'CREATE (codename:codename {{discourse_id: value.id, platform: "{dataset}"}}) '
+            f'{source} '
+            f'MERGE (codename:codename {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET codename.name = value.name '
             f'SET codename.code_id = value.tag_id '
             f'SET codename.language_id = value.language_id '
@@ -1444,38 +2950,27 @@ def graph_create_code_names(data):
             f'MATCH (language:language {{discourse_id: value.language_id, platform: "{dataset}"}}) '
             f'MATCH (code:code {{discourse_id: value.tag_id, platform: "{dataset}"}}) '
             f'WITH codename, language, code '
-            f'CREATE (codename)<-[:HAS_CODENAME]-(code) '
-            f'CREATE (codename)-[:IN_LANGUAGE]->(language) '
+            f'MERGE (codename)<-[:HAS_CODENAME]-(code) '
+            f'MERGE (codename)-[:IN_LANGUAGE]->(language) '
             f'WITH code, codename, language '
             f'CALL apoc.do.when(language.locale = "en",'
             f'"SET code.name = codename.name",'
             f'"",'
             f'{{code:code, codename:codename, language:language}}) '
             f'YIELD value AS value2 '
-            f'RETURN value2 '
+            f'RETURN value2 ',
+            params
         )
 
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'code_names'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_code_names, chunk, platform_name)
-                    print(f'Loaded code name data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import for code name on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'code_names', tx_create_code_names, 'code name')
 
 def graph_create_annotations(data):
     # Add annotations
 
-    def tx_create_annotations(tx, chunk, dataset):
+    def tx_create_annotations(tx, source, params, dataset):
         tx.run(
-            f'CALL apoc.load.json("file://{data_path}/{dataset}_annotations_{chunk}.json") '
-            f'YIELD value '
-            f'CREATE (annotation:annotation {{discourse_id: value.id, platform: "{dataset}"}}) '
+            f'{source} '
+            f'MERGE (annotation:annotation {{discourse_id: value.id, platform: "{dataset}"}}) '
             f'SET annotation.text = value.text '
             f'SET annotation.quote = value.quote '
             f'SET annotation.created_at = value.created_at '
@@ -1490,26 +2985,16 @@ def graph_create_annotations(data):
             f'MATCH (post:post {{discourse_id: value.post_id, platform: "{dataset}"}}) '
             f'MATCH (user:user {{discourse_id: value.creator_id, platform: "{dataset}"}}) '
             f'WITH code, post, user, annotation '
-            f'CREATE (code)<-[:REFERS_TO]-(annotation) '
-            f'CREATE (post)<-[:ANNOTATES]-(annotation) '
-            f'CREATE (user)-[:CREATED]->(annotation) '
-            f'SET annotation.creator_username = user.username '
+            f'MERGE (code)<-[:REFERS_TO]-(annotation) '
+            f'MERGE (post)<-[:ANNOTATES]-(annotation) '
+            f'MERGE (user)-[:CREATED]->(annotation) '
+            f'SET annotation.creator_username = user.username ',
+            params
         )
 
-    for platform in data.values():
-        with driver.session() as session:
-            platform_name = platform['site']['name']
-            topic = 'annotations'
-            chunks = platform['stats']['chunk_sizes'][topic]
-            for chunk in range(1, chunks + 1):
-                try:
-                    session.write_transaction(tx_create_annotations, chunk, platform_name)
-                    print(f'Loaded annotations data from {platform_name}, chunk #{chunk}')
-                except Exception as e:
-                    print(f'Import failed for annotations on {platform_name}, chunk #{chunk}')
-                    print(e)
+    load_chunks(data, 'annotations', tx_create_annotations, 'annotations')
 
-def graph_create_corpus():
+def graph_create_corpus(data):
     # Define ethno-tags as corpus identifiers
     # This function expects corpus identifiers to be unique across platforms
 
@@ -1539,32 +3024,145 @@ def graph_create_corpus():
             f'SET r.annotation_count = corpus_code_use '
         )
 
-    with driver.session() as session:
-        try:
-            session.write_transaction(tx_create_corpus)
-            print('Added corpus labels to graph')
-        except Exception as e:
-            print('Adding corpus labels to graph failed.')
-            print(e)
+    def tx_label_corpora(tx):
+        tx.run('MATCH (t:tag) WHERE t.name STARTS WITH "ethno-" SET t:corpus')
 
-    corpora = []
-    with driver.session() as session:
-        try:
-            corpora = session.read_transaction(tx_get_corpora)
-            if corpora:
-                for corpus in corpora:
-                    session.write_transaction(tx_create_corpus_annotation_counts, corpus)
-                print('Created annotation counts per corpus')
-        except Exception as e:
-            print('Getting corpora failed.')
-            print(e)
+    def tx_refresh_corpus_codes(tx, rows, dataset):
+        tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (corpus:corpus {{name: row.corpus, platform: "{dataset}"}}) '
+            f'MATCH (code:code {{discourse_id: row.code, platform: "{dataset}"}}) '
+            f'OPTIONAL MATCH (corpus)<-[:TAGGED_WITH]-(:topic)<-[:IN_TOPIC]-(:post)<-[:ANNOTATES]-(a:annotation)-[:REFERS_TO]->(code) '
+            f'WITH corpus, code, count(a) AS c '
+            f'OPTIONAL MATCH (code)-[old:IN_CORPUS]->(corpus) '
+            f'FOREACH (x IN CASE WHEN c = 0 AND old IS NOT NULL THEN [old] ELSE [] END | DELETE x) '
+            f'FOREACH (x IN CASE WHEN c > 0 THEN [c] ELSE [] END | MERGE (code)-[r:IN_CORPUS]->(corpus) SET r.annotation_count = x)',
+            rows=rows
+        )
+
+    if incremental:
+        # Only the codes of changed annotations and posts are counted again
+        with driver.session(database=graph_database) as session:
+            session.write_transaction(tx_label_corpora)
+            for platform in data.values():
+                dataset = platform['site']['name']
+                pairs, corpus_codes = annotation_changes(session, platform)
+                rows = [{'corpus': corpus, 'code': code} for corpus, code in sorted(corpus_codes)]
+                for batch in batches(rows):
+                    session.write_transaction(tx_refresh_corpus_codes, batch, dataset)
+                print(f'Refreshed annotation counts of {len(rows)} codes in corpora on {dataset}')
+        return
+
+    with driver.session(database=graph_database) as session:
+        session.write_transaction(tx_create_corpus)
+        print('Added corpus labels to graph')
+
+    with driver.session(database=graph_database) as session:
+        corpora = session.read_transaction(tx_get_corpora)
+        if corpora:
+            for corpus in corpora:
+                session.write_transaction(tx_create_corpus_annotation_counts, corpus)
+            print('Created annotation counts per corpus')
+
+# Codes that cooccur in fewer posts of a corpus are not linked. Cooccurrences counted here can also
+# carry normalized measures: jaccard, the share of the posts with either code that have both, and pmi,
+# the pointwise mutual information of the codes in base 2, over the annotated posts of the corpus.
+cooccurrence_min_count = config.get('cooccurrence_min_count', 1)
+cooccurrence_measures = config.get('cooccurrence_measures', ['jaccard', 'pmi'])
+
+# Full builds count cooccurrences here from the data files, when numpy and scipy are installed
+count_cooccurrences_here = np is not None and sparse is not None and not incremental
+
+def corpus_annotations(data):
+    # Posts and codes of the annotations in each corpus, as the cooccurrence pattern matches them:
+    # posts in topics tagged with an ethno- tag, annotated with codes that have an English code name.
+    # Only relationships that the loader stages create are followed. Returns the pairs of post and
+    # code ids by corpus name and platform.
+    corpora = {}
+    for platform in data.values():
+        dataset = platform['site']['name']
+
+        group_ids = set(group['id'] for group in topic_records(platform, 'groups'))
+        user_ids = IdSet(user['id'] for user in topic_records(platform, 'users'))
+        corpus_tags = {tag['id']: tag['name'] for tag in topic_records(platform, 'tags') if tag['name'].startswith('ethno-')}
+
+        # Categories merge their parent once they have a known group
+        category_ids = set()
+        for category in topic_records(platform, 'categories'):
+            category_ids.add(category['id'])
+            if category['parent_category_id'] is not None and any(gid in group_ids for gid in category['permissions']):
+                category_ids.add(category['parent_category_id'])
+
+        topic_corpora = {}
+        for topic in topic_records(platform, 'topics'):
+            if topic['category_id'] in category_ids and topic['user_id'] in user_ids:
+                names = set(corpus_tags[tid] for tid in topic['tags'] if tid in corpus_tags)
+                if names:
+                    topic_corpora[topic['id']] = names
+
+        post_corpora = {}
+        for post in topic_records(platform, 'posts'):
+            if post['topic_id'] in topic_corpora and post['user_id'] in user_ids:
+                post_corpora[post['id']] = topic_corpora[post['topic_id']]
+
+        english = set(language['id'] for language in topic_records(platform, 'languages') if language['locale'] == 'en')
+        code_ids = set(code['id'] for code in topic_records(platform, 'codes'))
+        named_codes = set(
+            name['tag_id'] for name in topic_records(platform, 'code_names')
+            if name['language_id'] in english and name['tag_id'] in code_ids
+        )
 
-def graph_create_code_cooccurrences():
+        for annotation in topic_records(platform, 'annotations'):
+            if annotation['tag_id'] in named_codes and annotation['post_id'] in post_corpora and annotation['creator_id'] in user_ids:
+                for name in post_corpora[annotation['post_id']]:
+                    corpora.setdefault(name, {}).setdefault(dataset, []).append((annotation['post_id'], annotation['tag_id']))
+    return corpora
+
+def count_cooccurrences(data):
+    # Count the posts of a corpus that each pair of codes annotate, as the upper triangle of AᵀA for the
+    # incidence matrix A of posts and codes. A post annotated twice with a code counts once.
+    # Returns rows of code pairs, from the lower code id, with their corpus, count and measures.
+    rows = []
+    for corpus, platforms in sorted(corpus_annotations(data).items()):
+        for dataset, annotations in platforms.items():
+            pairs = np.unique(np.array(annotations, dtype=np.int64), axis=0)
+            posts, post_index = np.unique(pairs[:, 0], return_inverse=True)
+            codes, code_index = np.unique(pairs[:, 1], return_inverse=True)
+            incidence = sparse.csr_matrix(
+                (np.ones(len(pairs), dtype=np.int64), (post_index.ravel(), code_index.ravel())),
+                shape=(len(posts), len(codes))
+            )
+            cooccurrences = sparse.triu(incidence.T @ incidence, k=1).tocoo()
+            code_posts = np.asarray(incidence.sum(axis=0)).ravel()
+
+            kept = cooccurrences.data >= cooccurrence_min_count
+            starts, ends, counts = cooccurrences.row[kept], cooccurrences.col[kept], cooccurrences.data[kept]
+            measures = {}
+            if 'jaccard' in cooccurrence_measures:
+                measures['jaccard'] = counts / (code_posts[starts] + code_posts[ends] - counts)
+            if 'pmi' in cooccurrence_measures:
+                measures['pmi'] = np.log2(counts * len(posts) / (code_posts[starts] * code_posts[ends]))
+            measures = {name: values.tolist() for name, values in measures.items()}
+
+            for i, (start, end, count) in enumerate(zip(codes[starts].tolist(), codes[ends].tolist(), counts.tolist())):
+                rows.append({
+                    'platform': dataset,
+                    'corpus': corpus,
+                    'start': start,
+                    'end': end,
+                    'count': count,
+                    'measures': {name: values[i] for name, values in measures.items()}
+                })
+    return rows
+
+def graph_create_code_cooccurrences(data):
     # Create code cooccurance network between codes
 
     def tx_create_cooccurrence_index(tx):
+        # The index is kept between incremental imports
         tx.run(
-            f'CALL db.index.fulltext.createRelationshipIndex("cooccurrenceRelationshipIndex",["COOCCURS"],["count"])'
+            f'CREATE FULLTEXT INDEX cooccurrenceRelationshipIndex IF NOT EXISTS '
+            f'FOR ()-[r:COOCCURS]-() ON EACH [r.count]'
         )
 
     def tx_create_code_cooccurrences(tx):
@@ -1572,84 +3170,741 @@ def graph_create_code_cooccurrences():
             f'MATCH (corpus:corpus)<-[:TAGGED_WITH]-()<-[:IN_TOPIC]-(p:post)<-[:ANNOTATES]-()-[:REFERS_TO]->(code1:code)-[:HAS_CODENAME]->(cn1:codename)-[:IN_LANGUAGE]->(l:language {{locale: "en"}}) '
             f'MATCH (corpus:corpus)<-[:TAGGED_WITH]-()<-[:IN_TOPIC]-(p:post)<-[:ANNOTATES]-()-[:REFERS_TO]->(code2:code)-[:HAS_CODENAME]->(cn2:codename)-[:IN_LANGUAGE]->(l:language {{locale: "en"}}) WHERE NOT ID(code1) = ID(code2) '
             f'WITH code1, code2, cn1, cn2, corpus, count(DISTINCT p) AS cooccurs '
-            f'MERGE (code1)-[r:COOCCURS {{count: cooccurs, corpus: corpus.name}}]-(code2) '
-            f'RETURN corpus.name, cn1.name, cn2.name, r.count ORDER BY r.count DESCENDING '
+            f'WHERE cooccurs >= $min_count '
+            f'MERGE (code1)-[r:COOCCURS {{corpus: corpus.name}}]-(code2) '
+            f'SET r.count = cooccurs '
+            f'RETURN corpus.name, cn1.name, cn2.name, r.count ORDER BY r.count DESCENDING ',
+            min_count=cooccurrence_min_count
+        )
+
+    def tx_create_counted_cooccurrences(tx, rows):
+        tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (code1:code {{discourse_id: row.start, platform: row.platform}}) '
+            f'MATCH (code2:code {{discourse_id: row.end, platform: row.platform}}) '
+            f'MERGE (code1)-[r:COOCCURS {{corpus: row.corpus}}]-(code2) '
+            f'SET r.count = row.count '
+            f'SET r += row.measures',
+            rows=rows
+        )
+
+    def tx_refresh_code_cooccurrences(tx, rows, dataset):
+        # Measures are left as the last full build computed them, they depend on the counts of the whole corpus
+        tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (code1:code {{discourse_id: row.start, platform: "{dataset}"}}) '
+            f'MATCH (code2:code {{discourse_id: row.end, platform: "{dataset}"}}) '
+            f'OPTIONAL MATCH (:corpus {{name: row.corpus}})<-[:TAGGED_WITH]-(:topic)<-[:IN_TOPIC]-(p:post)<-[:ANNOTATES]-(:annotation)-[:REFERS_TO]->(code1) '
+            f'WHERE EXISTS {{ (p)<-[:ANNOTATES]-(:annotation)-[:REFERS_TO]->(code2) }} '
+            f'AND EXISTS {{ (code1)-[:HAS_CODENAME]->(:codename)-[:IN_LANGUAGE]->(:language {{locale: "en"}}) }} '
+            f'AND EXISTS {{ (code2)-[:HAS_CODENAME]->(:codename)-[:IN_LANGUAGE]->(:language {{locale: "en"}}) }} '
+            f'WITH row, code1, code2, count(DISTINCT p) AS c '
+            f'OPTIONAL MATCH (code1)-[old:COOCCURS {{corpus: row.corpus}}]-(code2) '
+            f'FOREACH (x IN CASE WHEN c < $min_count AND old IS NOT NULL THEN [old] ELSE [] END | DELETE x) '
+            f'FOREACH (x IN CASE WHEN c >= $min_count THEN [c] ELSE [] END | MERGE (code1)-[r:COOCCURS {{corpus: row.corpus}}]-(code2) SET r.count = x)',
+            rows=rows,
+            min_count=cooccurrence_min_count
         )
 
-    with driver.session() as session:
+    with driver.session(database=graph_database) as session:
         session.write_transaction(tx_create_cooccurrence_index)
         print('Created cooccurrence index')
 
-    with driver.session() as session:
-        try:
+    with driver.session(database=graph_database) as session:
+        if count_cooccurrences_here:
+            rows = count_cooccurrences(data)
+            for i in range(0, len(rows), loader_batch_size):
+                session.write_transaction(tx_create_counted_cooccurrences, rows[i:i + loader_batch_size])
+        elif incremental:
+            for platform in data.values():
+                dataset = platform['site']['name']
+                pairs, corpus_codes = annotation_changes(session, platform)
+                rows = [{'corpus': corpus, 'start': start, 'end': end} for corpus, start, end in sorted(pairs)]
+                for batch in batches(rows):
+                    session.write_transaction(tx_refresh_code_cooccurrences, batch, dataset)
+                print(f'Refreshed cooccurrences of {len(rows)} pairs of codes on {dataset}')
+        else:
             session.write_transaction(tx_create_code_cooccurrences)
-            print('Created cooccurance graph')
-        except Exception as e:
-            print('Creating cooccurance graph failed.')
-            print(e)
+        print('Created cooccurance graph')
 
-def graph_create_code_use():
+def graph_create_code_use(data):
     # Create code use graph
 
     def tx_create_code_use(tx):
         tx.run(
             f'MATCH (user)-[r:CREATED]-(:annotation)-[:REFERS_TO]->(code:code) '
             f'WITH user, code, count(r) as use '
-            f'MERGE (user)-[:USED_CODE {{count: use}}]->(code) '
+            f'MERGE (user)-[r2:USED_CODE]->(code) '
+            f'SET r2.count = use '
         )
 
-    with driver.session() as session:
-        try:
-            session.write_transaction(tx_create_code_use)
-            print('Created code use graph')
-        except Exception as e:
-            print('Creating code use graph failed.')
-            print(e)
+    def tx_refresh_code_use(tx, rows, dataset):
+        tx.run(
+            f'UNWIND $rows AS row '
+            f'MATCH (user:user {{discourse_id: row.user, platform: "{dataset}"}}) '
+            f'MATCH (code:code {{discourse_id: row.code, platform: "{dataset}"}}) '
+            f'OPTIONAL MATCH (user)-[r:CREATED]->(:annotation)-[:REFERS_TO]->(code) '
+            f'WITH user, code, count(r) AS c '
+            f'OPTIONAL MATCH (user)-[old:USED_CODE]->(code) '
+            f'FOREACH (x IN CASE WHEN c = 0 AND old IS NOT NULL THEN [old] ELSE [] END | DELETE x) '
+            f'FOREACH (x IN CASE WHEN c > 0 THEN [c] ELSE [] END | MERGE (user)-[r2:USED_CODE]->(code) SET r2.count = x)',
+            rows=rows
+        )
+
+    if incremental:
+        # Only the users and codes of changed annotations, and of annotations of removed posts, are counted again
+        with driver.session(database=graph_database) as session:
+            for platform in data.values():
+                dataset = platform['site']['name']
+                uses = set((record['creator_id'], record['tag_id']) for record in topic_records(platform, 'annotations'))
+                uses.update(platform.get('previous_links', {}).get('uses', ()))
+                rows = [{'user': user, 'code': code} for user, code in sorted(uses)]
+                for batch in batches(rows):
+                    session.write_transaction(tx_refresh_code_use, batch, dataset)
+                print(f'Refreshed code use of {len(rows)} users and codes on {dataset}')
+        return
+
+    with driver.session(database=graph_database) as session:
+        session.write_transaction(tx_create_code_use)
+        print('Created code use graph')
 
 def graph_create_creator_code_cooccurrences():
     pass
 
-# Calls to update graph 
-graph_clear()
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_platform(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_groups(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_users(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_tags(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_categories(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_topics(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_posts(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_replies(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_quotes(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_interactions()
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_likes(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_languages(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_codes(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_code_ancestry(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_code_names(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_annotations(data)
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_corpus()
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_code_cooccurrences()
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
-graph_create_code_use()
-print("--- %s seconds ---" % (round(time.time() - start_time,2)))
+# Offline bulk builds write the graph as CSV files for neo4j-admin database import, which builds the store
+# in one pass instead of in transactions. Derived relationships are added after the import, see graph_stages.
+bulk_path = config.get('bulk_path', './bulk')
+bulk_database = config.get('bulk_database', 'neo4j')
+bulk_array_delimiter = ';'
+
+# Properties of each node label, as the loader stages set them: property, record field and type
+bulk_properties = {
+    'group': [('name', 'name', 'string')],
+    'user': [
+        ('username', 'username', 'string'), ('email', 'email', 'string'), ('consent', 'consent', 'string'),
+        ('consent_updated', 'consent_updated', 'string'), ('groups', 'groups', 'long[]')
+    ],
+    'tag': [
+        ('name', 'name', 'string'), ('topic_count', 'topic_count', 'long'),
+        ('created_at', 'created_at', 'string'), ('updated_at', 'updated_at', 'string')
+    ],
+    'category': [
+        ('name', 'name', 'string'), ('name_lower', 'name_lower', 'string'), ('created_at', 'created_at', 'string'),
+        ('updated_at', 'updated_at', 'string'), ('read_restricted', 'read_restricted', 'boolean'),
+        ('parent_category_id', 'parent_category_id', 'long'), ('permissions', 'permissions', 'long[]')
+    ],
+    'topic': [
+        ('title', 'title', 'string'), ('created_at', 'created_at', 'string'), ('updated_at', 'updated_at', 'string'),
+        ('user_id', 'user_id', 'long'), ('is_message_thread', 'is_message_thread', 'boolean'),
+        ('tags', 'tags', 'long[]'), ('category_id', 'category_id', 'long')
+    ],
+    'post': [
+        ('user_id', 'user_id', 'long'), ('topic_id', 'topic_id', 'long'), ('post_number', 'post_number', 'long'),
+        ('raw_excerpt', 'raw_excerpt', 'string'), ('raw_length', 'raw_length', 'long'), ('raw_hash', 'raw_hash', 'string'),
+        ('created_at', 'created_at', 'string'), ('updated_at', 'updated_at', 'string'), ('deleted_at', 'deleted_at', 'string'),
+        ('hidden', 'hidden', 'boolean'), ('word_count', 'word_count', 'long'), ('wiki', 'wiki', 'boolean'),
+        ('reads', 'reads', 'long'), ('score', 'score', 'double'), ('like_count', 'like_count', 'long'),
+        ('reply_count', 'reply_count', 'long'), ('quote_count', 'quote_count', 'long'),
+        ('username', 'username', 'string'), ('topic_title', 'topic_title', 'string')
+    ],
+    'language': [('name', 'name', 'string'), ('locale', 'locale', 'string')],
+    'code': [
+        ('name', 'name', 'string'), ('description', 'description', 'string'), ('creator_id', 'creator_id', 'long'),
+        ('created_at', 'created_at', 'string'), ('updated_at', 'updated_at', 'string'),
+        ('ancestry', 'ancestry', 'string'), ('annotations_count', 'annotations_count', 'long'),
+        ('root_id', 'root_id', 'long'), ('depth', 'depth', 'long')
+    ],
+    'codename': [
+        ('name', 'name', 'string'), ('code_id', 'tag_id', 'long'), ('language_id', 'language_id', 'long'),
+        ('created_at', 'created_at', 'string')
+    ],
+    'annotation': [
+        ('text', 'text', 'string'), ('quote', 'quote', 'string'), ('created_at', 'created_at', 'string'),
+        ('updated_at', 'updated_at', 'string'), ('code_id', 'tag_id', 'long'), ('post_id', 'post_id', 'long'),
+        ('creator_id', 'creator_id', 'long'), ('type', 'type', 'string'), ('topic_id', 'topic_id', 'long'),
+        ('creator_username', 'creator_username', 'string')
+    ]
+}
+
+def bulk_value(value):
+    # CSV cell of a property. Empty cells leave the property unset, like setting it to null.
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return bulk_array_delimiter.join(str(item) for item in value)
+    return value
+
+class BulkFiles:
+    # The CSV files of a bulk build. Each node label and relationship type has its own file,
+    # with its header on the first line. Node ids are unique per label, each label has its own id space.
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.files = {}
+        self.writers = {}
+        self.nodes = []
+        self.relationships = []
+
+    def writer(self, name, header, kind, label):
+        if name not in self.writers:
+            file = open(f'{self.path}/{name}.csv', 'w', newline='', encoding='utf-8')
+            self.files[name] = file
+            self.writers[name] = csv.writer(file)
+            self.writers[name].writerow(header)
+            kind.append((label, f'{self.path}/{name}.csv'))
+        return self.writers[name]
+
+    def node(self, label, id, record):
+        # Nodes of Discourse records are keyed by their id and platform, like in the loader stages
+        properties = bulk_properties[label]
+        header = [f':ID({label})', 'discourse_id:long', 'platform'] + [f'{name}:{kind}' for name, field, kind in properties]
+        row = [id, record['id'], record['platform']] + [bulk_value(record.get(field)) for name, field, kind in properties]
+        self.writer(label, header, self.nodes, label).writerow(row)
+
+    def other_node(self, label, header, row):
+        self.writer(label, header, self.nodes, label).writerow(row)
+
+    def relationship(self, type, start_label, start, end_label, end, properties=()):
+        # Derived relationships carry properties, as (name, type, value)
+        name = f'{type}_{start_label}_{end_label}'
+        header = [f':START_ID({start_label})', f':END_ID({end_label})'] + [f'{name}:{kind}' for name, kind, value in properties]
+        row = [start, end] + [value for name, kind, value in properties]
+        self.writer(name, header, self.relationships, type).writerow(row)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+    def command(self):
+        arguments = [
+            'neo4j-admin database import full',
+            '--overwrite-destination',
+            '--multiline-fields=true',
+            f'--array-delimiter="{bulk_array_delimiter}"'
+        ]
+        arguments += [f'--nodes={label}="{path}"' for label, path in self.nodes]
+        arguments += [f'--relationships={type}="{path}"' for type, path in self.relationships]
+        arguments.append(bulk_database)
+        return ' \\\n    '.join(arguments)
+
+def write_bulk_import(data):
+    # Write the graph that the loader stages would build from the data files, as files for neo4j-admin.
+    # Relationships are only written where the stages would create them, where the nodes they match exist.
+    # Derived properties, like the username and topic title of posts, are looked up here.
+    try:
+        os.mkdir(bulk_path)
+    except OSError:
+        pass
+    bulk = BulkFiles(bulk_path)
+    global_users = {}
+    accounts = set()
+
+    for platform in data.values():
+        dataset = platform['site']['name']
+        print(f'Writing bulk import files for {dataset}...')
+
+        def node_id(id):
+            return f'{dataset}:{id}'
+
+        def records(topic):
+            for record in topic_records(platform, topic):
+                record['platform'] = dataset
+                yield record
+
+        bulk.other_node('platform', [':ID(platform)', 'name', 'url'], [dataset, dataset, bulk_value(platform['site'].get('url'))])
+
+        group_ids = set()
+        for group in records('groups'):
+            group_ids.add(group['id'])
+            bulk.node('group', node_id(group['id']), group)
+            bulk.relationship('ON_PLATFORM', 'group', node_id(group['id']), 'platform', dataset)
+
+        usernames = {}
+        for user in records('users'):
+            usernames[user['id']] = user['username']
+            bulk.node('user', node_id(user['id']), user)
+            bulk.relationship('ON_PLATFORM', 'user', node_id(user['id']), 'platform', dataset)
+            # Global users are only linked through users in at least one known group
+            groups = sorted(set(gid for gid in user['groups'] if gid in group_ids))
+            for gid in groups:
+                bulk.relationship('IN_GROUP', 'user', node_id(user['id']), 'group', node_id(gid))
+            if groups:
+                global_users[user['email']] = user['username']
+                bulk.relationship('IS_GLOBAL_USER', 'user', node_id(user['id']), 'globaluser', user['email'])
+                if (user['email'], dataset) not in accounts:
+                    accounts.add((user['email'], dataset))
+                    bulk.relationship('HAS_ACCOUNT_ON', 'globaluser', user['email'], 'platform', dataset)
+
+        tag_ids = set()
+        for tag in records('tags'):
+            tag_ids.add(tag['id'])
+            bulk.node('tag', node_id(tag['id']), tag)
+            bulk.relationship('ON_PLATFORM', 'tag', node_id(tag['id']), 'platform', dataset)
+
+        categories = list(records('categories'))
+        category_ids = set(category['id'] for category in categories)
+        for category in categories:
+            bulk.node('category', node_id(category['id']), category)
+            bulk.relationship('ON_PLATFORM', 'category', node_id(category['id']), 'platform', dataset)
+            permissions = sorted(set(gid for gid in category['permissions'] if gid in group_ids))
+            for gid in permissions:
+                bulk.relationship('HAS_ACCESS', 'group', node_id(gid), 'category', node_id(category['id']))
+            parent = category['parent_category_id']
+            if permissions and parent is not None:
+                if parent not in category_ids:
+                    # The loader merges a category without properties for a parent that was not extracted
+                    category_ids.add(parent)
+                    bulk.node('category', node_id(parent), {'id': parent, 'platform': dataset})
+                bulk.relationship('PARENT_CATEGORY_OF', 'category', node_id(parent), 'category', node_id(category['id']))
+
+        titles = {}
+        for topic in records('topics'):
+            titles[topic['id']] = topic['title']
+            bulk.node('topic', node_id(topic['id']), topic)
+            bulk.relationship('ON_PLATFORM', 'topic', node_id(topic['id']), 'platform', dataset)
+            if topic['category_id'] not in category_ids:
+                continue
+            bulk.relationship('IN_CATEGORY', 'topic', node_id(topic['id']), 'category', node_id(topic['category_id']))
+            if topic['user_id'] not in usernames:
+                continue
+            bulk.relationship('CREATED', 'user', node_id(topic['user_id']), 'topic', node_id(topic['id']))
+            for tid in sorted(set(tid for tid in topic['tags'] if tid in tag_ids)):
+                bulk.relationship('TAGGED_WITH', 'topic', node_id(topic['id']), 'tag', node_id(tid))
+
+        post_ids = array('q')
+        for post in records('posts'):
+            post_ids.append(post['id'])
+            user = post['user_id'] in usernames
+            topic = post['topic_id'] in titles
+            if user and topic:
+                post['username'] = usernames[post['user_id']]
+                post['topic_title'] = titles[post['topic_id']]
+            bulk.node('post', node_id(post['id']), post)
+            bulk.relationship('ON_PLATFORM', 'post', node_id(post['id']), 'platform', dataset)
+            if user:
+                bulk.relationship('CREATED', 'user', node_id(post['user_id']), 'post', node_id(post['id']))
+            if user and topic:
+                bulk.relationship('IN_TOPIC', 'post', node_id(post['id']), 'topic', node_id(post['topic_id']))
+        post_ids = IdSet(post_ids)
+
+        for reply in records('replies'):
+            if reply['reply_post_id'] in post_ids and reply['post_id'] in post_ids:
+                bulk.relationship('IS_REPLY_TO', 'post', node_id(reply['reply_post_id']), 'post', node_id(reply['post_id']))
+
+        for quote in records('quotes'):
+            if quote['quoted_post_id'] in post_ids and quote['post_id'] in post_ids:
+                bulk.relationship('CONTAINS_QUOTE_FROM', 'post', node_id(quote['post_id']), 'post', node_id(quote['quoted_post_id']))
+
+        for like in records('likes'):
+            if like['post_id'] in post_ids and like['user_id'] in usernames:
+                bulk.relationship('LIKES', 'user', node_id(like['user_id']), 'post', node_id(like['post_id']))
+
+        locales = {}
+        for language in records('languages'):
+            locales[language['id']] = language['locale']
+            bulk.node('language', node_id(language['id']), language)
+            bulk.relationship('ON_PLATFORM', 'language', node_id(language['id']), 'platform', dataset)
+
+        # Codes are named by their English code name
+        codes = list(records('codes'))
+        code_ids = set(code['id'] for code in codes)
+        names = {}
+        for name in records('code_names'):
+            bulk.node('codename', node_id(name['id']), name)
+            if name['language_id'] in locales and name['tag_id'] in code_ids:
+                bulk.relationship('HAS_CODENAME', 'code', node_id(name['tag_id']), 'codename', node_id(name['id']))
+                bulk.relationship('IN_LANGUAGE', 'codename', node_id(name['id']), 'language', node_id(name['language_id']))
+                if locales[name['language_id']] == 'en':
+                    names[name['tag_id']] = name['name']
+        ancestor_ids = set()
+        for code in codes:
+            code['name'] = names.get(code['id'], code.get('name'))
+            ancestors = code_ancestors(code)
+            code['root_id'] = ancestors[0][0] if ancestors else code['id']
+            code['depth'] = len(ancestors)
+            bulk.node('code', node_id(code['id']), code)
+            bulk.relationship('ON_PLATFORM', 'code', node_id(code['id']), 'platform', dataset)
+            if code['creator_id'] in usernames:
+                bulk.relationship('CREATED', 'user', node_id(code['creator_id']), 'code', node_id(code['id']))
+            for id, depth in ancestors:
+                if id not in code_ids and id not in ancestor_ids:
+                    # The ancestry stage merges a code without properties for an ancestor that was not extracted
+                    ancestor_ids.add(id)
+                    bulk.node('code', node_id(id), {'id': id, 'platform': dataset})
+                bulk.relationship('HAS_ANCESTOR', 'code', node_id(code['id']), 'code', node_id(id), [('depth', 'long', depth)])
+                if depth == 1:
+                    bulk.relationship('HAS_PARENT_CODE', 'code', node_id(code['id']), 'code', node_id(id))
+
+        for annotation in records('annotations'):
+            linked = annotation['tag_id'] in code_ids and annotation['post_id'] in post_ids and annotation['creator_id'] in usernames
+            if linked:
+                annotation['creator_username'] = usernames[annotation['creator_id']]
+            bulk.node('annotation', node_id(annotation['id']), annotation)
+            if linked:
+                bulk.relationship('REFERS_TO', 'annotation', node_id(annotation['id']), 'code', node_id(annotation['tag_id']))
+                bulk.relationship('ANNOTATES', 'annotation', node_id(annotation['id']), 'post', node_id(annotation['post_id']))
+                bulk.relationship('CREATED', 'user', node_id(annotation['creator_id']), 'annotation', node_id(annotation['id']))
+
+    # Global users are shared by platforms, and named after their last account
+    for email, username in global_users.items():
+        bulk.other_node('globaluser', [':ID(globaluser)', 'email', 'username'], [email, email, username])
+
+    # Interactions counted here are written with the graph, the other derived relationships are added after the import
+    if count_interactions_here:
+        for type, label, directed, rows in count_interactions(data):
+            for row in rows:
+                if label == 'user':
+                    bulk.relationship(type, 'user', f'{row["platform"]}:{row["start"]}', 'user', f'{row["platform"]}:{row["end"]}', [('count', 'long', row['count'])])
+                else:
+                    bulk.relationship(type, 'globaluser', row['start'], 'globaluser', row['end'], [('count', 'long', row['count'])])
+
+    bulk.close()
+    command = bulk.command()
+    with open(f'{bulk.path}/import.sh', 'w') as file:
+        file.write(command + '\n')
+    print('')
+    print(f'Wrote bulk import files to {bulk.path}. With the database {bulk_database} stopped, import them with:')
+    print('')
+    print(command)
+    print('')
+    print('Then start the database and run this script with --after-bulk to add indexes and derived relationships.')
+
+# Stages that load data files with load_chunks, and that the plan audit checks
+loader_stages = (
+    'groups', 'users', 'tags', 'categories', 'topics', 'posts', 'replies', 'quotes', 'likes',
+    'languages', 'codes', 'code_names', 'annotations'
+)
+
+# Stages that derive relationships from the graph, which run after a bulk import
+derived_stages = ('interactions', 'corpus', 'code_cooccurrences', 'code_use')
+
+def graph_stages(data, bulk=False, audit=False):
+    # Stages of the graph build, with the stages that must be complete before each can start.
+    # A stage depends on the stages that create the nodes and relationships it matches.
+    # Interactions counted here only need the users, and wait for the likes so as not to contend for their locks.
+    # Cooccurrences counted here only need the codes, and likewise wait for the stages that link to them.
+    # After a bulk import only the derived stages run, once the indexes are created, unless the bulk files hold them.
+    # An audit only runs the loader stages, which then explain their statements without loading data.
+    # It leaves the indexes as they are, so it checks the plans of the database as it is.
+    stages = {
+        'indexes': (graph_create_indexes, []),
+        'platform': (partial(graph_create_platform, data), ['indexes']),
+        'groups': (partial(graph_create_groups, data), ['platform']),
+        'users': (partial(graph_create_users, data), ['platform', 'groups']),
+        'tags': (partial(graph_create_tags, data), ['platform']),
+        'categories': (partial(graph_create_categories, data), ['platform', 'groups']),
+        'topics': (partial(graph_create_topics, data), ['categories', 'users', 'tags']),
+        'posts': (partial(graph_create_posts, data), ['users', 'topics']),
+        'replies': (partial(graph_create_replies, data), ['posts']),
+        'quotes': (partial(graph_create_quotes, data), ['posts']),
+        'interactions': (partial(graph_create_interactions, data), ['users', 'likes'] if count_interactions_here else ['replies', 'quotes', 'likes']),
+        'likes': (partial(graph_create_likes, data), ['users', 'posts']),
+        'languages': (partial(graph_create_languages, data), ['platform']),
+        'codes': (partial(graph_create_codes, data), ['platform', 'users']),
+        'code_ancestry': (partial(graph_create_code_ancestry, data), ['codes']),
+        'code_names': (partial(graph_create_code_names, data), ['languages', 'codes']),
+        'annotations': (partial(graph_create_annotations, data), ['codes', 'posts', 'users']),
+        'corpus': (partial(graph_create_corpus, data), ['tags', 'topics', 'annotations']),
+        'code_cooccurrences': (partial(graph_create_code_cooccurrences, data), ['code_names', 'annotations'] if count_cooccurrences_here else ['corpus', 'code_names']),
+        'code_use': (partial(graph_create_code_use, data), ['annotations'])
+    }
+    if bulk:
+        stages = {
+            name: (function, [dependency for dependency in dependencies if dependency in derived_stages] + ['indexes'])
+            for name, (function, dependencies) in stages.items()
+            if name in derived_stages and not (name == 'interactions' and count_interactions_here)
+        }
+        stages['indexes'] = (graph_create_indexes, [])
+    if audit:
+        stages = {
+            name: (function, [])
+            for name, (function, dependencies) in stages.items() if name in loader_stages
+        }
+    return stages
+
+# Stages that run at the same time, each with its own loader threads
+stage_workers = config.get('stage_workers', 4)
+
+def run_stages(stages):
+    # Run the stages of the graph build, each as soon as the stages it depends on are complete.
+    # Stages that fail, and the stages that depend on them, are reported and left out.
+    # Returns whether all stages completed, after printing the critical path of the build,
+    # the chain of dependent stages that took longest and so sets the duration of the build.
+    for name, (function, dependencies) in stages.items():
+        for dependency in dependencies:
+            if dependency not in stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dependency}')
+
+    durations = {}
+    finished = {}
+    failed = set()
+    running = {}
+    waiting = dict(stages)
+    build_start = time.time()
+
+    def run_stage(name, function):
+        start = time.time()
+        function()
+        return time.time() - start
+
+    with ThreadPoolExecutor(max_workers=stage_workers) as executor:
+        while waiting or running:
+            for name, (function, dependencies) in list(waiting.items()):
+                if any(dependency in failed for dependency in dependencies):
+                    print(f'Skipping stage {name}, a stage it depends on failed.')
+                    failed.add(name)
+                    del waiting[name]
+                elif all(dependency in durations for dependency in dependencies):
+                    print(f'Starting stage {name}')
+                    running[executor.submit(run_stage, name, function)] = name
+                    del waiting[name]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    durations[name] = future.result()
+                    finished[name] = time.time() - build_start
+                    print(f'Finished stage {name} in {round(durations[name], 2)} seconds')
+                except Exception as e:
+                    failed.add(name)
+                    print(f'Stage {name} failed.')
+                    print(e)
+                print("--- %s seconds ---" % (round(time.time() - start_time,2)))
+
+    # Longest chain of completed stages ending at each stage
+    chains = {}
+    for name in sorted(durations, key=lambda name: finished[name]):
+        previous = [chains[dependency] for dependency in stages[name][1]]
+        longest = max(previous, key=lambda chain: chain[0], default=(0, []))
+        chains[name] = (longest[0] + durations[name], longest[1] + [name])
+    if chains:
+        length, path = max(chains.values(), key=lambda chain: chain[0])
+        print(f'Built graph in {round(time.time() - build_start, 2)} seconds, stages took {round(sum(durations.values()), 2)} seconds in total.')
+        print(f'Critical path of {round(length, 2)} seconds: ' + ' -> '.join(f'{name} ({round(durations[name], 2)}s)' for name in path))
+    return not failed
+
+# Blue/green builds load each full build into a new database, a generation, while the API keeps serving
+# the current one. A generation that matches the extraction is switched to, by pointing a database alias
+# at it, or a generation pointer that the API reads. The previous generation is kept for rollback.
+blue_green = config.get('blue_green', False)
+serving_database = config.get('serving_database', 'graphryder')
+blue_green_switch = config.get('blue_green_switch', 'alias')
+generation_database = config.get('generation_database', 'neo4j')
+
+# Nodes of each label in a complete build, from the record counts of the data files.
+# Stages merge categories and codes for parents that were not extracted, so there can be more of those.
+generation_counts = {
+    'group': ('groups', False),
+    'user': ('users', False),
+    'tag': ('tags', False),
+    'category': ('categories', True),
+    'topic': ('topics', False),
+    'post': ('posts', False),
+    'language': ('languages', False),
+    'code': ('codes', True),
+    'codename': ('code_names', False),
+    'annotation': ('annotations', False)
+}
+
+def load_generations():
+    # Generations of the graph, as the last switch left them
+    try:
+        with open('./db/generations.json') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {'generation': 0, 'current': None, 'previous': None}
 
-# TODO
-# Add post permissions with HAS_ACCESS to groups to enable granular graph access
\ No newline at end of file
+def save_generations(generations):
+    with open('./db/generations.json', 'w') as file:
+        json.dump(generations, file)
+
+def next_generation(generations):
+    # Database of the next generation
+    return f'{serving_database}-{generations["generation"] + 1}'
+
+def create_generation(database, replace=True):
+    # Create an empty database for a generation. A database that a bulk import has filled is only registered.
+
+    def tx_create_database(tx):
+        if replace:
+            tx.run(f'CREATE OR REPLACE DATABASE `{database}` WAIT')
+        else:
+            tx.run(f'CREATE DATABASE `{database}` IF NOT EXISTS WAIT')
+
+    with driver.session(database='system') as session:
+        session.write_transaction(tx_create_database)
+    print(f'Created database {database}')
+
+def validate_generation(data, database):
+    # Compare the nodes in a new generation to the records extracted. Returns the differences found.
+
+    def tx_count(tx, label):
+        return tx.run(f'MATCH (n:{label}) RETURN count(n) AS count').single()['count']
+
+    problems = []
+    with driver.session(database=database) as session:
+        for label, (topic, more) in generation_counts.items():
+            expected = sum(platform['counts'][topic] for platform in data.values())
+            count = session.read_transaction(tx_count, label)
+            if count < expected or (count > expected and not more):
+                problems.append(f'{count} {label} nodes, expected {expected}')
+    return problems
+
+def switch_generation(database):
+    # Point the API at a database, in one step
+
+    def tx_alias(tx):
+        tx.run(f'CREATE OR REPLACE ALIAS `{serving_database}` FOR DATABASE `{database}`')
+
+    def tx_pointer(tx):
+        tx.run(
+            'MERGE (g:generation {name: $name}) '
+            'SET g.database = $database '
+            'SET g.switched_at = datetime() ',
+            name=serving_database, database=database
+        )
+
+    if blue_green_switch == 'alias':
+        with driver.session(database='system') as session:
+            session.write_transaction(tx_alias)
+    else:
+        with driver.session(database=generation_database) as session:
+            session.write_transaction(tx_pointer)
+    print(f'Switched {serving_database} to {database}')
+
+def drop_generation(database):
+
+    def tx_drop_database(tx):
+        tx.run(f'DROP DATABASE `{database}` IF EXISTS')
+
+    with driver.session(database='system') as session:
+        session.write_transaction(tx_drop_database)
+    print(f'Dropped database {database}')
+
+def promote_generation(data, generations, database):
+    # Switch to a new generation if it is complete. Only the previous generation is kept.
+    problems = validate_generation(data, database)
+    if problems:
+        print(f'Generation in {database} does not match the data files and is not switched to:')
+        for problem in problems:
+            print(f'    {problem}')
+        return False
+    switch_generation(database)
+    if generations['previous']:
+        drop_generation(generations['previous'])
+    generations.update({
+        'generation': generations['generation'] + 1,
+        'current': database,
+        'previous': generations['current']
+    })
+    save_generations(generations)
+    return True
+
+def rollback_generation():
+    # Switch back to the previous generation. The current one becomes the previous, so this can be undone.
+    generations = load_generations()
+    if not generations['previous']:
+        print('There is no previous generation to roll back to.')
+        exit(1)
+    switch_generation(generations['previous'])
+    generations['current'], generations['previous'] = generations['previous'], generations['current']
+    save_generations(generations)
+
+# Worker processes for parallel extraction import this script, so the import only runs when it is executed.
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Import Discourse databases into a Neo4j graph.')
+    parser.add_argument('--offline-bulk', action='store_true',
+        help='write the graph as files for neo4j-admin database import, instead of loading it into Neo4j')
+    parser.add_argument('--after-bulk', action='store_true',
+        help='add indexes and derived relationships to a graph built by a bulk import of the current data files')
+    parser.add_argument('--rollback', action='store_true',
+        help='switch the API back to the previous generation of a blue/green build')
+    parser.add_argument('--audit-plans', action='store_true',
+        help='check the query plans of all loader statements against the graph as it is, without extracting or loading data')
+    args = parser.parse_args()
+    if (args.offline_bulk or args.after_bulk) and incremental:
+        print('Bulk imports always build the whole graph and cannot be incremental.')
+        exit(1)
+
+    uri = config['neo4j_uri']
+    if args.rollback:
+        driver = GraphDatabase.driver(uri, auth=(config['neo4j_user'], config['neo4j_password']))
+        rollback_generation()
+        exit(0)
+
+    # Full builds of blue/green imports go to the database of the next generation, incremental ones
+    # update the current generation. Bulk imports are written for the next generation too.
+    if blue_green:
+        generations = load_generations()
+        if incremental:
+            if not generations['current']:
+                print('Blue/green incremental imports need a generation from a full build first.')
+                exit(1)
+            graph_database = generations['current']
+        else:
+            graph_database = bulk_database = next_generation(generations)
+    elif args.after_bulk:
+        graph_database = bulk_database
+
+    # Load data from Discourse psql databases and dump to json files
+    # Data is loaded from JSON files because Neo4j APOC functions are optimized for this.
+    # With the Bolt transport or the memory format, records are sent to Neo4j as parameters instead.
+    # After a bulk import the graph is built from the data files already there, so they are not extracted again.
+    # Audits only read the data files too, so the manifest and pending watermarks are left as they are.
+    dbs = databases[:]
+    if config['reload_from_database'] and not args.after_bulk and not args.audit_plans:
+        reload_data(dbs)
+    data = load_data(dbs)
+    data_path = os.path.abspath('./db/')
+    print("--- %s seconds ---" % (round(time.time() - start_time,2)))
+
+    if args.offline_bulk:
+        write_bulk_import(data)
+        print("--- %s seconds ---" % (round(time.time() - start_time,2)))
+        exit(0)
+
+    # Audits check the database the API serves, and fail on any plan that scans nodes
+    if args.audit_plans:
+        driver = GraphDatabase.driver(uri, auth=(config['neo4j_user'], config['neo4j_password']))
+        if blue_green:
+            graph_database = generations['current']
+        audit_only = True
+        plan_audit = 'fail'
+        exit(0 if run_stages(graph_stages(data, audit=True)) else 1)
+
+    # Build Neo4j database
+
+    # TODO: Refactor 'for platform in data.values()' loop into function
+    # TODO: Refactor create index into function
+
+    print(' ')
+    print('Building Neo4j database...')
+    print(' ')
+    print("--- %s seconds ---" % (round(time.time() - start_time,2)))
+    driver = GraphDatabase.driver(uri, auth=(config['neo4j_user'], config['neo4j_password']))
+
+    # Calls to update graph 
+    if incremental:
+        graph_remove_content(data)
+    elif blue_green:
+        create_generation(graph_database, replace=not args.after_bulk)
+    elif not args.after_bulk:
+        graph_clear()
+    print("--- %s seconds ---" % (round(time.time() - start_time,2)))
+    if not run_stages(graph_stages(data, bulk=args.after_bulk)) or failed_chunks:
+        # Data of failed stages and chunks is loaded again by the next import
+        print('Graph build incomplete, watermarks are not committed.')
+        exit(1)
+    if blue_green and not incremental and not promote_generation(data, generations, graph_database):
+        print('The API still serves the current generation, watermarks are not committed.')
+        exit(1)
+    commit_watermarks(dbs)
+    commit_loaded_chunks(data)
+
+    # TODO
+    # Add post permissions with HAS_ACCESS to groups to enable granular graph access
\ No newline at end of file